@@ -1,22 +1,75 @@
+import time
+RERUN_STARTED = time.perf_counter()
+
 import streamlit as st
 st.set_page_config(page_title="テロップ自動生成AI", layout="wide")
 
+import functools
+import json
+import math
 import os
 import re
-import json
-import tiktoken
-import pandas as pd
+import statistics
+import openai
 from dotenv import load_dotenv
-from openai import OpenAI
-from datetime import timedelta
+from backends import make_backend
+from captions import (
+    CAPTION_SCHEMA, COMBINED_SCHEMA, PACKED_CAPTION_SCHEMA, SIDE_CAPTION_SCHEMA, JsonObjectStream, filter_captions,
+    insert_repaired, is_caption_shaped, parse_captions, parse_combined_captions, parse_packed_captions,
+    parse_side_caption, parse_structured_captions, parse_structured_side_caption, rejected_captions,
+    response_format_for, strip_code_fence, validate_times,
+)
+from pipeline import ChunkParseError, OutputTruncated, RetryPolicy, run_pipeline
+from endpoint_pool import Endpoint, EndpointPool, load_pool_config, make_pool
+from hedging import Hedger
+from llm_cache import ResponseCache, prompt_hash
+from model_stats import ModelStats
+from ratelimit import RateLimiter
+from singleflight import SingleFlight
+from prompts import (
+    STRUCTURED_CAPTION_INSTRUCTION, STRUCTURED_COMBINED_INSTRUCTION, STRUCTURED_PACKED_CAPTION_INSTRUCTION,
+    STRUCTURED_SIDE_CAPTION_INSTRUCTION, build_caption_prompt, build_combined_prompt, build_packed_caption_prompt,
+    build_repair_prompt, build_side_caption_prompt,
+)
+from timecode import FPS, format_frames
+from tokenizer import is_approximate, token_counter
+from transcript import (
+    CHUNK_SECONDS, ChunkPack, ParsedTranscript, auto_pack_size, pack_chunks, partition_chapters, segment_durations,
+    transcript_key,
+)
+
+# ── 重いオブジェクトはプロセスで1つだけ作り、再実行のたびに作り直さない ──
+@st.cache_resource
+def load_environment() -> None:
+    load_dotenv()
+
+# ── 再実行の所要時間（SHOW_RERUN_TIMING=1 のとき画面に出す） ──
+def show_rerun_timing(stage: str) -> None:
+    if os.getenv("SHOW_RERUN_TIMING") != "1":
+        return
+    ms = (time.perf_counter() - RERUN_STARTED) * 1000
+    history = st.session_state.setdefault("rerun_ms", [])
+    history.append(ms)
+    del history[:-20]
+    st.caption(f"⏱ 再実行 {ms:.0f} ms（{stage}まで。直近 {len(history)} 回の中央値 {statistics.median(history):.0f} ms）")
 
 # ── 環境変数読み込み ──
-load_dotenv()
+load_environment()
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+LLM_POOL = os.getenv("LLM_POOL")
 API_KEY = os.getenv("OPENAI_API_KEY")
-if not API_KEY:
+if not LLM_POOL and LLM_BACKEND == "openai" and not API_KEY:
     st.error("OPENAI_API_KEY が設定されていません。`.env` を確認してください。")
     st.stop()
-client = OpenAI(api_key=API_KEY)
+# LLM_BACKEND=mock のときの応答の出方（mock_server.py の同名オプションと同じ）
+MOCK_OPTIONS = {
+    "latency": float(os.getenv("MOCK_LATENCY", "1.0")),
+    "latency_sigma": float(os.getenv("MOCK_LATENCY_SIGMA", "0.5")),
+    "error_rate": float(os.getenv("MOCK_ERROR_RATE", "0")),
+    "error_status": int(os.getenv("MOCK_ERROR_STATUS", "500")),
+    "truncate_rate": float(os.getenv("MOCK_TRUNCATE_RATE", "0")),
+    "seed": int(os.getenv("MOCK_SEED", "0")),
+}
 
 # ── パスワード設定 ──
 APP_PASSWORD = os.getenv("APP_PASSWORD", "my_secret_password")
@@ -25,54 +78,260 @@ APP_PASSWORD = os.getenv("APP_PASSWORD", "my_secret_password")
 password_input = st.text_input("パスワードを入力してください", type="password")
 if password_input != APP_PASSWORD:
     st.warning("正しいパスワードを入力してください。")
+    show_rerun_timing("認証画面")
     st.stop()
 
 # ── 定数 ──
-MODEL = "gpt-3.5-turbo"
+MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+# 安い順に並べたモデル。前のモデルで不合格だったチャンクだけ次のモデルで再実行する
+MODEL_CASCADE = os.getenv("MODEL_CASCADE", MODEL)
+MIN_CAPTIONS_PER_CHUNK = 2
 MAX_TOKENS = 2000
+MODEL_CONTEXT_TOKENS = int(os.getenv("MODEL_CONTEXT_TOKENS", "16385"))
+MODEL_MAX_OUTPUT_TOKENS = int(os.getenv("MODEL_MAX_OUTPUT_TOKENS", "4096"))
+# 20秒チャンク1つあたりの出力見込み（テロップ3件前後＋JSON の枠に余裕を持たせた値）
+OUTPUT_TOKENS_PER_CHUNK = 400
+PACK_MAX_CHUNKS = 12
 
 # ── トークン数計測 ──
-encoding = tiktoken.encoding_for_model(MODEL)
+# エンコーディングはデプロイ時に用意した tiktoken_cache/（tokenizer.py seed）から、初めて数えるときに読み込む。
+# 用意されていないノードではダウンロードせず概算で数える
 def count_tokens(text: str) -> int:
-    return len(encoding.encode(text))
-
-# ── タイムコード単位分割（20秒以上で分割） ──
-def parse_timecode(timecode: str) -> timedelta:
-    h, m, s = map(int, timecode.split(":"))
-    return timedelta(hours=h, minutes=m, seconds=s)
-
-def chunk_by_timestamp(text: str) -> list[str]:
-    lines = text.splitlines(keepends=True)
-    chunks = []
-    buf = ""
-    start_time = None
-
-    for line in lines:
-        match = re.match(r'^(\d{2}:\d{2}:\d{2})', line)
-        if match:
-            current_time = parse_timecode(match.group(1))
-            if start_time is None:
-                start_time = current_time
-            else:
-                duration = current_time - start_time
-                if duration.total_seconds() >= 20:
-                    chunks.append(buf)
-                    buf = ""
-                    start_time = current_time
-            buf += line
-        else:
-            buf += line
-    if buf:
-        chunks.append(buf)
-    return chunks
+    return token_counter(MODEL)(text)
+
+# ── 出力トークン数の見積もり（max_tokens をチャンクの話量に合わせる） ──
+TOKENS_PER_CAPTION = 60        # {"start", "end", "caption", "category"} 1件ぶん
+INPUT_TOKENS_PER_CAPTION = 50  # 原稿この程度ごとにテロップ1件（20秒で2〜3件）
+OUTPUT_OVERHEAD_TOKENS = 40    # 配列・オブジェクトの枠（束ねた場合はチャンクごと）
+SIDE_CAPTION_TOKENS = 80
+PACK_HEADER_RE = re.compile(r"^\[チャンク \d+\]$", re.M)
+
+def output_token_budget(chunk_tokens: int, units: int = 1, extra: int = 0) -> int:
+    # 見込み件数より1件多めに取る。途切れたら send_sized が倍にして取り直す
+    captions = math.ceil(chunk_tokens / INPUT_TOKENS_PER_CAPTION) + units
+    return min(MODEL_MAX_OUTPUT_TOKENS, OUTPUT_OVERHEAD_TOKENS * units + TOKENS_PER_CAPTION * captions + extra)
+
+# ── レート制限（組織の上限はプロセス全体で共有） ──
+RATE_LIMIT_RPM = int(os.getenv("RATE_LIMIT_RPM", "3500"))
+RATE_LIMIT_TPM = int(os.getenv("RATE_LIMIT_TPM", "90000"))
+
+@st.cache_resource
+def get_rate_limiter(rpm: int, tpm: int) -> RateLimiter:
+    return RateLimiter(rpm, tpm)
+
+rate_limiter = get_rate_limiter(RATE_LIMIT_RPM, RATE_LIMIT_TPM)
+
+# ── 接続先（LLM_POOL を指定すると複数の接続先に振り分け、レート制限も接続先ごとになる） ──
+# HTTP のコネクションプール（TLS 接続）も、mock のスタブサーバも再実行をまたいで使い回される
+@st.cache_resource
+def get_endpoint_pool(pool_config: str, rpm: int, tpm: int) -> EndpointPool:
+    return make_pool(load_pool_config(pool_config), make_backend, (rpm, tpm))
+
+@st.cache_resource
+def get_single_endpoint(kind: str, api_key: str, base_url: str, mock_options: dict) -> EndpointPool:
+    return EndpointPool([Endpoint(kind, make_backend(kind, api_key, base_url, mock_options), limiter=rate_limiter)])
+
+if LLM_POOL:
+    try:
+        llm_pool = get_endpoint_pool(LLM_POOL, RATE_LIMIT_RPM, RATE_LIMIT_TPM)
+    except ValueError as e:
+        st.error(f"LLM_POOL の設定を読み込めません: {e}")
+        st.stop()
+else:
+    llm_pool = get_single_endpoint(LLM_BACKEND, API_KEY, os.getenv("OPENAI_BASE_URL"), MOCK_OPTIONS)
+
+# ── ヘッジ（p90 を過ぎても返らないリクエストに複製を送る。複製は全体の HEDGE_BUDGET 割合まで） ──
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+
+@st.cache_resource
+def get_hedger(_pool: EndpointPool, pool_key: str, budget: float) -> Hedger:
+    return Hedger(_pool.complete, budget)
+
+hedger = get_hedger(llm_pool, LLM_POOL or LLM_BACKEND, HEDGE_BUDGET)
+
+# ── リトライ（一時的な API エラーと壊れた JSON は指数バックオフで再試行） ──
+RETRY_ATTEMPTS = 4
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, ChunkParseError):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return isinstance(e, openai.APIConnectionError)
+
+def describe_error(e: Exception) -> str:
+    if isinstance(e, ChunkParseError):
+        return f"パース失敗: {e}"
+    if isinstance(e, OutputTruncated):
+        return f"出力途切れ: {e}"
+    return f"{type(e).__name__}: {e}"
+
+retry_policy = RetryPolicy(attempts=RETRY_ATTEMPTS, retryable=is_retryable)
+
+# ── 応答キャッシュ（同じプロンプトの再実行で再課金しない） ──
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".cache/llm_responses.sqlite3")
+LLM_CACHE_MAX_MB = int(os.getenv("LLM_CACHE_MAX_MB", "200"))
+
+@st.cache_resource
+def get_response_cache(path: str, max_mb: int) -> ResponseCache:
+    return ResponseCache(path, max_mb * 1024 * 1024)
+
+response_cache = get_response_cache(LLM_CACHE_PATH, LLM_CACHE_MAX_MB)
+
+# ── 同一リクエストの相乗り（セッションをまたいで共有） ──
+@st.cache_resource
+def get_single_flight() -> SingleFlight:
+    return SingleFlight()
+
+single_flight = get_single_flight()
+
+# ── 出力形式（構造化出力なら API 側でスキーマどおりの JSON に固定される） ──
+OUTPUT_MODES = {
+    "JSONモード": "json_object",
+    "JSON Schema（厳格・gpt-4o-mini 以降）": "json_schema",
+    "従来（応答テキストから JSON を抜き出す）": "text",
+}
+
+def structured_request(instruction: str, schema: dict) -> tuple[list[dict], dict]:
+    # 構造化出力モードのときに添える system メッセージと response_format
+    response_format = response_format_for(output_mode, schema)
+    if response_format is None:
+        return [], None
+    return [{"role": "system", "content": instruction}], response_format
+
+# ── API 呼び出し ──
+def create_completion(
+    prompt: str, max_tokens: int, temperature: float, validate,
+    instruction: str = "", schema: dict = None, on_item=None, item_level: int = 0,
+    model: str = MODEL, stats: ModelStats = None,
+) -> str:
+    system, response_format = structured_request(instruction, schema) if schema else ([], None)
+    messages = system + [{"role": "user", "content": prompt}]
+    # キャッシュと相乗りのキーは、指示と出力形式まで含めたリクエスト全体で作る
+    rendered = json.dumps({"messages": messages, "response_format": response_format}, ensure_ascii=False)
+    if use_cache:
+        cached = response_cache.get(model, rendered, temperature, max_tokens)
+        if cached is not None:
+            return cached
+    # 他のセッションが同じプロンプトを送信中なら、その応答を待って使う
+    key = (model, prompt_hash(rendered), temperature, max_tokens)
+    return single_flight.do(key, lambda: request_completion(
+        messages, rendered, response_format, max_tokens, temperature, validate, on_item, item_level, model, stats,
+    ))
+
+def request_completion(
+    messages: list[dict], rendered: str, response_format, max_tokens: int, temperature: float, validate,
+    on_item=None, item_level: int = 0, model: str = MODEL, stats: ModelStats = None,
+) -> str:
+    # プロンプト＋max_tokens 分を接続先のレート制限に予約してから送信し、応答ヘッダで残量を補正する
+    prompt_tokens = sum(count_tokens(m["content"]) for m in messages)
+    on_delta = None
+    if on_item is not None:
+        # 閉じ括弧が届いたテロップから順に on_item へ渡す（item_level はテロップを包む { の数）
+        objects = JsonObjectStream(level=item_level)
+        def on_delta(delta: str) -> None:
+            for item in objects.feed(delta):
+                on_item(item)
+    started = time.monotonic()
+    complete = hedger.complete if use_hedging else llm_pool.complete
+    result = complete(model, messages, max_tokens, temperature, response_format, on_delta, prompt_tokens + max_tokens)
+    content = result.content
+    if stats is not None:
+        # usage が返ってこない互換サーバでは手元のトークン数で代用する
+        stats.record_call(
+            model, time.monotonic() - started,
+            result.prompt_tokens if result.prompt_tokens is not None else prompt_tokens,
+            result.completion_tokens if result.completion_tokens is not None else count_tokens(content),
+        )
+    if result.finish_reason == "length":
+        raise OutputTruncated(content, max_tokens)
+    # パースできた応答だけ保存する（壊れた応答を保存すると再試行でも同じものが返ってしまう）
+    try:
+        validate(content)
+    except Exception:
+        return content
+    response_cache.put(model, rendered, temperature, max_tokens, content)
+    return content
+
+def parse_caption_response(raw: str) -> list[dict]:
+    return parse_captions(raw) if output_mode == "text" else parse_structured_captions(raw)
+
+def parse_side_caption_response(raw: str) -> list[dict]:
+    return parse_side_caption(raw) if output_mode == "text" else parse_structured_side_caption(raw)
+
+def parse_packed_response(raw: str) -> dict[int, list[dict]]:
+    return parse_packed_captions(strip_code_fence(raw) if output_mode == "text" else raw)
+
+def send_sized(
+    prompt: str, max_tokens: int, temperature: float, validate, instruction: str, schema: dict,
+    on_item, item_level: int, model: str, stats: ModelStats,
+) -> str:
+    # 途中で切れたら max_tokens を倍にして取り直す（届いた分は表示済みなので、取り直しはストリーミングしない）
+    while True:
+        try:
+            return create_completion(
+                prompt, max_tokens, temperature, validate, instruction, schema,
+                on_item if use_streaming else None, item_level, model, stats,
+            )
+        except OutputTruncated:
+            if max_tokens >= MODEL_MAX_OUTPUT_TOKENS:
+                raise
+            max_tokens = min(MODEL_MAX_OUTPUT_TOKENS, max_tokens * 2)
+            on_item = None
+
+@functools.lru_cache(maxsize=None)
+def template_tokens(template: str) -> int:
+    # 指示文だけのトークン数（送信スレッドから呼ばれるので Streamlit のキャッシュは使わない）
+    return count_tokens(template)
+
+def send_caption_prompt(prompt: str, on_item, model: str = MODEL, stats: ModelStats = None) -> str:
+    chunk_tokens = count_tokens(prompt) - template_tokens(build_caption_prompt(""))
+    return send_sized(
+        prompt, output_token_budget(chunk_tokens), 0.8, parse_caption_response,
+        STRUCTURED_CAPTION_INSTRUCTION, CAPTION_SCHEMA, on_item, 0 if output_mode == "text" else 1, model, stats,
+    )
+
+def send_packed_caption_prompt(prompt: str, on_item, model: str = MODEL, stats: ModelStats = None) -> str:
+    # 応答は {"chunks": [{"chunk_id": …, "captions": [テロップ…]}]} なので、テロップは { 2つの内側
+    chunk_tokens = count_tokens(prompt) - template_tokens(build_packed_caption_prompt([]))
+    units = len(PACK_HEADER_RE.findall(prompt))
+    return send_sized(
+        prompt, output_token_budget(chunk_tokens, units), 0.8, parse_packed_response,
+        STRUCTURED_PACKED_CAPTION_INSTRUCTION, PACKED_CAPTION_SCHEMA, on_item, 2, model, stats,
+    )
+
+def parse_combined_response(raw: str):
+    return parse_combined_captions(strip_code_fence(raw) if output_mode == "text" else raw)
+
+def send_combined_prompt(prompt: str, on_item, model: str = MODEL, stats: ModelStats = None) -> str:
+    chunk_tokens = count_tokens(prompt) - template_tokens(build_combined_prompt(""))
+    return send_sized(
+        prompt, output_token_budget(chunk_tokens, extra=SIDE_CAPTION_TOKENS), 0.8, parse_combined_response,
+        STRUCTURED_COMBINED_INSTRUCTION, COMBINED_SCHEMA, on_item, 1, model, stats,
+    )
+
+def caption_steps(kind: str) -> tuple:
+    # (build_prompt, send, parse)。kind は "chunks"（チャンクごと）/ "packed"（束ねる）/ "combined"（章ごとにまとめ生成）
+    if kind == "packed":
+        return build_packed_caption_prompt, send_packed_caption_prompt, parse_packed_response
+    if kind == "combined":
+        return build_combined_prompt, send_combined_prompt, parse_combined_response
+    return build_caption_prompt, send_caption_prompt, parse_caption_response
+
+def send_side_caption_prompt(prompt: str, on_item, model: str = MODEL, stats: ModelStats = None) -> str:
+    return send_sized(
+        prompt, 300, 0.7, parse_side_caption_response, STRUCTURED_SIDE_CAPTION_INSTRUCTION, SIDE_CAPTION_SCHEMA,
+        None, 0, model, stats,
+    )
 
 # ── Streamlit UI ──
 st.title("✂️ テロップ自動生成AI")
 
 st.markdown("""
 - タイムコード付きの文字起こし原稿を丸ごと入力欄に貼り付けてください。
+    - 対応形式：`HH:MM:SS` / `HH:MM:SS:FF` / `mm:ss` の行頭タイムコード、SRT、WebVTT（自動判定）
 - 「生成開始」のボタンをクリックします。
-- テロップの作成が始まります。しばらくお待ちください（20分尺の動画で5分くらい）
+- テロップの作成が始まります。しばらくお待ちください（20分尺の動画で5分くらい。同時リクエスト数を増やすと短くなります）
 - 完了したら、生成されたテロップが表示されます。
 - CSVをダウンロードしてPremiereに反映してください。
 - 各カテゴリの要件：
@@ -84,118 +343,352 @@ st.markdown("""
 
 transcript = st.text_area("▶ タイムコード付き文字起こしを貼り付け", height=300)
 
+fps = st.number_input("フレームレート（fps）", min_value=1, max_value=120, value=FPS, step=1)
+
+models = [m.strip() for m in st.text_input(
+    "使用モデル（安い順にカンマ区切り）", value=MODEL_CASCADE,
+    help="先頭のモデルで全チャンクを生成し、パース失敗やテロップ不足（pointが無いなど）のチャンクだけ次のモデルで再実行します。",
+).split(",") if m.strip()] or [MODEL]
+
+chunk_mode = st.radio("チャンク分割方式", ["20秒ごと", "トークン上限でまとめる"], horizontal=True)
+if chunk_mode == "トークン上限でまとめる":
+    col_tokens, col_seconds = st.columns(2)
+    chunk_token_budget = col_tokens.number_input("1チャンクの最大トークン数", min_value=100, max_value=8000, value=1500, step=100)
+    chunk_max_seconds = col_seconds.number_input("1チャンクの最大秒数", min_value=20, max_value=600, value=120, step=10)
+
+use_packing = st.checkbox(
+    "複数チャンクを1リクエストにまとめて送る（指示文の重複送信を減らし、入力トークンを節約）", value=False,
+    help="まとめる数はコンテキスト長と出力上限から自動で決めます。",
+)
+
+col_balance, col_chapters = st.columns(2)
+chapter_balance = col_balance.radio("サイドテロップの章の分け方", ["尺で均等", "トークン数で均等"], horizontal=True)
+max_chapters = col_chapters.number_input("章の数", min_value=1, max_value=30, value=8, step=1)
+use_combined = st.checkbox(
+    "テロップとサイドテロップを章ごとに1回のリクエストでまとめて生成する", value=False,
+    help="原稿を章の単位で1回だけ送り、テロップと見出しを同時に受け取ります（チャンク分割・まとめ送信の設定は使いません）。"
+         "結果の表と CSV はこれまでどおり別々に出します。",
+)
+
+concurrency = st.slider("同時リクエスト数", min_value=1, max_value=16, value=4)
+use_cache = st.checkbox("キャッシュを使う（オフにすると再生成して結果を上書き保存）", value=True)
+output_mode = OUTPUT_MODES[st.radio(
+    "出力形式", list(OUTPUT_MODES), horizontal=True,
+    help="JSONモード／JSON Schema では API 側で JSON に固定するため、応答の抜き出しや整形が不要になります。"
+         "スキーマに合わない応答はその場でパース失敗として再試行します。",
+)]
+use_streaming = st.checkbox("ストリーミングで受信し、テロップを届いた順に表示する", value=True)
+use_repair = st.checkbox("文字数などの条件で落ちたテロップを、まとめて1回だけ書き直してもらう", value=True)
+use_hedging = st.checkbox(
+    "遅いリクエストには複製を送り、先に返った方を使う（ヘッジ）",
+    help=f"直近の p90 レイテンシ（ストリーミングでは最初の文字が届くまで）を過ぎても応答がないとき、"
+         f"同じリクエストをもう1件送ります。複製は全リクエストの {HEDGE_BUDGET:.0%} までで、使わなかった方の費用は別に集計します。",
+)
+limits = rate_limiter.snapshot()
+cache_stats = response_cache.stats()
+flight_stats = single_flight.stats()
+# プールのときのレート制限は接続先ごとなので、下の「接続先の状態」を見る
+rate_status = "" if LLM_POOL else (
+    f"レート制限: {limits['rpm_remaining']:,}/{limits['rpm_limit']:,} RPM・"
+    f"{limits['tpm_remaining']:,}/{limits['tpm_limit']:,} TPM（累計待機 {limits['waited_sec']}秒） / "
+)
+st.caption(
+    f"接続先: {llm_pool.label} / {rate_status}"
+    f"キャッシュ: ヒット {cache_stats['hits']:,}・ミス {cache_stats['misses']:,}・"
+    f"{cache_stats['entries']:,} 件（{cache_stats['bytes'] / 1024 / 1024:.1f}/{LLM_CACHE_MAX_MB} MB） / "
+    f"同一リクエスト相乗り: {flight_stats['coalesced']:,} 件"
+)
+with st.expander("接続先の状態（健全性・スループット）", expanded=False):
+    pool_table = st.empty()
+
+def show_pool_status() -> None:
+    # 送信中も更新できるよう、画面の最後と生成の途中で書き直す
+    hedge = hedger.snapshot()
+    with pool_table.container():
+        st.caption(
+            f"障害による接続先の切り替え: {llm_pool.failovers:,} 回 / "
+            f"ヘッジ: 複製 {hedge['hedged']:,}/{hedge['requests']:,} 件（上限 {HEDGE_BUDGET:.0%}）・"
+            f"複製が先着 {hedge['hedge_wins']:,} 件・追加 入力 {hedge['extra_prompt_tokens']:,}／"
+            f"出力 {hedge['extra_completion_tokens']:,} トークン（約 ${hedge['extra_cost']:.4f}）"
+        )
+        st.table(llm_pool.rows())
+
+def keep_captions(caps: list[dict]) -> list[dict]:
+    return filter_captions(validate_times(caps, fps))
+
+def reject_captions(caps: list[dict]) -> list[dict]:
+    return rejected_captions(validate_times(caps, fps))
+
+# ── 進捗表示 ──
+def chunk_status(run: dict, total: int) -> str:
+    return "".join(
+        "✅" if i in run["done"] else "❌" if i in run["failed"] else "⏳" for i in range(1, total + 1)
+    )
+
+def in_timeline_order(done: dict) -> list[dict]:
+    # 完了順に届いたチャンクをタイムライン順に並べて連結する
+    return [cap for i in sorted(done) for cap in done[i]]
+
+# ── 解析済み原稿（本文が変わったときだけ作り直す） ──
+def load_parsed_transcript(text: str) -> ParsedTranscript:
+    parsed = st.session_state.get("parsed_transcript")
+    if parsed is None or parsed.key != transcript_key(text, fps):
+        parsed = ParsedTranscript(text, fps)
+        st.session_state.parsed_transcript = parsed
+    return parsed
+
+def caption_chunks(parsed: ParsedTranscript) -> list:
+    if chunk_mode == "トークン上限でまとめる":
+        return parsed.token_chunks(count_tokens, chunk_token_budget, chunk_max_seconds)
+    return parsed.chunks()
+
+def packed_prompt_tokens() -> int:
+    return count_tokens(build_packed_caption_prompt([])) + count_tokens(STRUCTURED_PACKED_CAPTION_INSTRUCTION)
+
+def caption_spans(parsed: ParsedTranscript) -> list:
+    # まとめ送信では、指示文1回＋K チャンク＋出力見込みが上限に収まる K で束ねる
+    spans = caption_chunks(parsed)
+    if not use_packing or not spans:
+        return spans
+    size = auto_pack_size(
+        parsed.span_tokens(spans, count_tokens), packed_prompt_tokens(), OUTPUT_TOKENS_PER_CHUNK,
+        MODEL_CONTEXT_TOKENS, MODEL_MAX_OUTPUT_TOKENS, PACK_MAX_CHUNKS,
+    )
+    return pack_chunks(spans, size)
+
+def chapter_spans(parsed: ParsedTranscript) -> list:
+    table = parsed.table
+    if chapter_balance == "トークン数で均等":
+        weights = parsed.token_counts(count_tokens)
+    else:
+        weights = segment_durations(table)
+    # 短い動画では1章あたり20秒未満にならないよう章数を減らす
+    total_ms = table.end_ms[-1] - table.start_ms[0] if len(table) else 0
+    n_chapters = min(max_chapters, max(1, total_ms // (CHUNK_SECONDS * 1000)))
+    return partition_chapters(table, n_chapters, weights)
+
+parsed = load_parsed_transcript(transcript) if transcript.strip() else None
+if use_combined and parsed is not None:
+    # テロップとサイドテロップで原稿を2回送っていたのが、章ごとに1回になる
+    n_chapters = len(chapter_spans(parsed))
+    combined_tokens = n_chapters * count_tokens(build_combined_prompt("")) + parsed.total_tokens(count_tokens)
+    st.caption(
+        f"形式: {parsed.table.fmt} / セグメント数: {len(parsed.table)} / "
+        f"章数: {n_chapters}（テロップとサイドテロップを同時に生成） / 送信トークン見込み: 約 {combined_tokens:,}"
+    )
+elif parsed is not None:
+    # 指示文はリクエストごとに再送されるので、リクエスト数 × 指示文 ＋ 原稿全体 で見積もる
+    n_chunks = len(caption_chunks(parsed))
+    est_tokens = n_chunks * count_tokens(build_caption_prompt("")) + parsed.total_tokens(count_tokens)
+    summary = f"チャンク数: {n_chunks} / 送信トークン見込み: 約 {est_tokens:,}"
+    if use_packing and n_chunks:
+        n_requests = len(caption_spans(parsed))
+        packed_tokens = n_requests * packed_prompt_tokens() + parsed.total_tokens(count_tokens)
+        summary = (
+            f"チャンク数: {n_chunks}（{n_requests} リクエストにまとめる） / "
+            f"送信トークン見込み: 約 {packed_tokens:,}（まとめない場合 約 {est_tokens:,}）"
+        )
+    st.caption(f"形式: {parsed.table.fmt} / セグメント数: {len(parsed.table)} / {summary}")
+if parsed is not None and is_approximate(MODEL):
+    st.caption("⚠️ tiktoken のエンコーディングが未配置のため、トークン数は概算です（`python tokenizer.py seed` で用意できます）。")
+
 if "all_captions" not in st.session_state:
     st.session_state.all_captions = []
 
 if "side_captions" not in st.session_state:
     st.session_state.side_captions = []
 
+# ── チャンク単位の実行（失敗しても止めずに続行し、失敗分だけ後から再実行できる） ──
+def new_run(spans: list, kind: str = "chunks") -> dict:
+    return {
+        "text_key": parsed.key, "spans": spans, "done": {}, "failed": {}, "rejected": {}, "kind": kind,
+        "stats": ModelStats(),
+    }
+
+# ── 合否判定（不合格のチャンクは次のモデルで再実行する） ──
+def captions_accepted(span, caps: list[dict]) -> bool:
+    # フィルタ後のテロップが最低件数あり、point を1つ以上含むこと（束ねた場合はチャンク数ぶん）
+    units = len(span.parts) if isinstance(span, ChunkPack) else 1
+    points = sum(cap.get("category") == "point" for cap in caps)
+    return points >= units and len(caps) >= MIN_CAPTIONS_PER_CHUNK * units
+
+def side_caption_accepted(span, caps: list[dict]) -> bool:
+    return bool(caps)
+
+def side_captions_of(run: dict) -> list[dict]:
+    # 開始時刻が返ってこない場合は章の先頭タイムコードを使う
+    for i, caps in run["done"].items():
+        for cap in caps:
+            cap.setdefault("start", format_frames(run["spans"][i - 1].start_ms, fps))
+    return in_timeline_order(run["done"])
+
+def run_chunks(
+    run: dict, indices: list[int], label: str, build_prompt, send, parse, keep=lambda caps: caps, reject=None,
+    side_run: dict = None, model: str = MODEL, accept=captions_accepted,
+) -> None:
+    # side_run を渡すと、まとめ生成で一緒に返ってきた見出しをそちらの結果に入れる
+    spans = run["spans"]
+    stats = run["stats"]
+    progress = st.progress(0.0, text=f"{label}を送信中…")
+    status = st.empty()
+    preview = st.empty()
+    finished = 0
+
+    def show_partial(jobs) -> None:
+        # 送信中のチャンクは、届いた分だけフィルタを通して差し込む（まだ検証していないので形の崩れたものは除く）
+        partial = {
+            job.index: keep([dict(cap) for cap in job.partial if is_caption_shaped(cap)]) for job in jobs if job.partial
+        }
+        if partial:
+            preview.json(in_timeline_order({**run["done"], **partial}))
+        show_pool_status()
+
+    def send_with_model(prompt, on_item):
+        return send(prompt, on_item, model=model, stats=stats)
+
+    for result in run_pipeline(
+        parsed.text, [spans[i - 1] for i in indices], build_prompt, send_with_model, parse, keep,
+        concurrency, retry_policy, indices, show_partial, reject,
+    ):
+        finished += 1
+        previous = run["done"].get(result.index)
+        if result.error is not None:
+            stats.record_chunk(model, False)
+            # 上位モデルでの再実行に失敗した場合は、前のモデルの結果を残す
+            if previous is None:
+                raw = getattr(result.error, "raw", None)
+                run["failed"][result.index] = {"message": describe_error(result.error), "raw": raw, "attempts": result.attempts}
+        else:
+            accepted = accept(result.span, result.captions)
+            stats.record_chunk(model, accepted)
+            if previous is None or accepted or len(result.captions) > len(previous):
+                run["done"][result.index] = result.captions
+                run["failed"].pop(result.index, None)
+                run["rejected"].pop(result.index, None)
+                if result.rejected:
+                    run["rejected"][result.index] = result.rejected
+                if side_run is not None:
+                    side_run["done"][result.index] = result.side
+        progress.progress(finished / len(indices), text=f"▶ {label} {finished}/{len(indices)} 完了（直近: {result.index}）")
+        status.write(chunk_status(run, len(spans)))
+        preview.json(in_timeline_order(run["done"]))
+        show_pool_status()
+    status.empty()
+    preview.empty()
+
+def run_cascade(
+    run: dict, indices: list[int], label: str, build_prompt, send, parse, keep=lambda caps: caps, reject=None,
+    side_run: dict = None, accept=captions_accepted,
+) -> None:
+    # 安いモデルから順に実行し、失敗・不合格のチャンクだけを次のモデルへ回す
+    for model in models:
+        run_chunks(run, indices, f"{label}（{model}）", build_prompt, send, parse, keep, reject, side_run, model, accept)
+        indices = [
+            i for i in indices
+            if i in run["failed"] or not accept(run["spans"][i - 1], run["done"][i])
+        ]
+        if not indices:
+            break
+
+def captions_csv(rows: list[dict]) -> str:
+    # pandas は CSV を出すときだけ読み込む（結果が無い再実行では読み込まない）
+    import pandas as pd
+
+    return pd.DataFrame(rows).to_csv(index=False)
+
+def show_model_stats(run: dict) -> None:
+    rows = run["stats"].rows()
+    if rows:
+        with st.expander("モデル別の合格率・レイテンシ・費用"):
+            st.table(rows)
+
+# ── 落ちたテロップの修正依頼（1回の実行につき1リクエストにまとめる） ──
+REPAIR_MAX_CAPTIONS = 40
+
+def repair_rejected(run: dict) -> None:
+    rejected = [cap for i in sorted(run["rejected"]) for cap in run["rejected"][i]]
+    run["rejected"] = {}
+    if not use_repair or not rejected:
+        return
+    batch = rejected[:REPAIR_MAX_CAPTIONS]
+    with st.spinner(f"条件を満たさなかったテロップ {len(batch)} 件を書き直し中…"):
+        try:
+            # 安いモデルで守れなかったルールの書き直しなので、いちばん強いモデルに頼む
+            raw = create_completion(
+                build_repair_prompt(batch), min(MAX_TOKENS, 200 + 80 * len(batch)), 0.8,
+                parse_caption_response, STRUCTURED_CAPTION_INSTRUCTION, CAPTION_SCHEMA,
+                model=models[-1], stats=run["stats"],
+            )
+            repaired = validate_times(parse_caption_response(raw), fps)
+        except Exception as e:
+            st.warning(f"⚠️ テロップの書き直しに失敗しました: {describe_error(e)}")
+            return
+
+    restored = insert_repaired(run["done"], [span.start_ms for span in run["spans"]], repaired, fps)
+    st.info(f"書き直し: 条件を満たさなかった {len(rejected)} 件のうち {len(batch)} 件を依頼し、{restored} 件を復元しました。")
+
+def show_failures(run: dict, label: str, key: str) -> bool:
+    # 失敗一覧を出し、「失敗したチャンクだけ再実行」が押されたら True を返す
+    failed = run["failed"]
+    # 再試行しないエラー（400 など）は1回で諦めているので、実際に試した回数を出す
+    attempts = sorted({f["attempts"] for f in failed.values()})
+    tried = f"{attempts[0]} 回" if len(attempts) == 1 else f"{attempts[0]}〜{attempts[-1]} 回"
+    st.warning(f"⚠️ {label} {len(failed)} 件が失敗しました（{tried}試行）。完了分は保持しています。")
+    with st.expander("失敗の詳細"):
+        for i in sorted(failed):
+            st.write(f"{label} {i}（{failed[i]['attempts']} 回試行）: {failed[i]['message']}")
+            if failed[i]["raw"]:
+                st.code(failed[i]["raw"], language="json")
+    if parsed is None or parsed.key != run["text_key"]:
+        st.caption("文字起こしが変更されたため、再実行するには最初から生成してください。")
+        return False
+    return st.button("失敗したチャンクだけ再実行", key=f"retry_{key}")
+
 if st.button("生成開始"):
     if not transcript.strip():
         st.error("文字起こしを貼り付けてください。")
         st.stop()
 
-    st.info("チャンク分割中…")
-    chunks = chunk_by_timestamp(transcript)
-    st.write(f"▶ 全体を **{len(chunks)}** チャンクに分割しました。")
-
-    all_captions = []
-    for i, chunk in enumerate(chunks, start=1):
-        st.write(f"▶ チャンク {i}/{len(chunks)} を処理中…")
-
-        prompt = f"""
-以下は動画のセリフ文字起こし（タイムコード付き）の断片です。
-この内容を「視聴者に一番伝えたいポイントを要約したテロップ」にリライトしてください。
-30秒あたりに**2〜3つ以上**のテロップを作成してください。
-必ずpointカテゴリを1つ以上生成してください（pointカテゴリは詳細説明文です）。
-
-カテゴリと文字数ルール：
-- positive/negative/neutral：17文字以内。
-- positive/negative/neutralのカテゴリーは、文章が中途半端な状態で終わる場合は、次の文章と合体させて１回で完結させてください。次の文章と合体できず、中途半端な文章になってしまう場合は、そのテロップは削除してください。つまり、中途半端な文章は生成しないでください
-- point（詳細説明・解説・回答的内容）：20文字以上40文字未満。
-- pointカテゴリは必ず説明文形式で、文末は「〜です」または「〜ます」で終えること。
-- テロップ内の句読点（。、）は半角スペースに置換してください（！や？はそのままOK）。
-- pointカテゴリは必ずpositive/negative/neutralと交互に出力し、連続してpointを出さないこと。
-
-カテゴリ定義：
-- positive：前向き、モチベーション、安心感。
-- negative：注意喚起、問題提起、リスク。
-- neutral：中立的で客観的な事実説明。
-- point：詳細説明、理由、特徴、回答的な内容。
-
-出力形式は以下のJSONでお願いします：
-[
-  {{
-    "start":"HH:MM:SS",
-    "end":"HH:MM:SS",
-    "caption":"ここにテロップ",
-    "category":"positive"
-  }},
-  …
-]
-
-断片：
-{chunk}
-"""
-        resp = client.chat.completions.create(
-            model=MODEL,
-            messages=[{"role":"user","content": prompt}],
-            max_tokens=MAX_TOKENS,
-            temperature=0.8,
-        )
-        raw = resp.choices[0].message.content
-
-        m = re.search(r"```(?:json)?\s*([\s\S]*?)```", raw)
-        clean = m.group(1).strip() if m else raw.strip()
-        clean = "\n".join([ln for ln in clean.splitlines() if ln.strip()])
-
-        try:
-            caps = json.loads(clean)
-        except json.JSONDecodeError as e:
-            st.error(f"チャンク {i} のパース失敗: {e}")
-            st.code(raw, language="json")
-            st.stop()
-
-        filtered_caps = []
-        last_category = ""
-        for cap in caps:
-            caption_text = cap.get("caption", "")
-            category = cap.get("category", "").lower()
-            caption_length = len(caption_text)
-
-            caption_text = caption_text.replace("。", " ").replace("、", " ")
-
-            if category in ["positive", "negative", "neutral"]:
-                if caption_length <= 17:
-                    cap["caption"] = caption_text
-                    filtered_caps.append(cap)
-                    last_category = category
-            elif category == "point":
-                if 15 <= caption_length < 40:
-                    if caption_text.endswith("です") or caption_text.endswith("ます"):
-                        if last_category != "point":
-                            cap["caption"] = caption_text
-                            filtered_caps.append(cap)
-                            last_category = category
-                        else:
-                            continue
-            else:
-                continue
-
-        all_captions.extend(filtered_caps)
-
-    st.session_state.all_captions = all_captions
-
-    if not all_captions:
-        st.warning("⚠️ 条件を満たすテロップが生成されませんでした。プロンプトや入力を見直してください。")
+    if use_combined:
+        chapters = chapter_spans(parsed)
+        run = st.session_state.caption_run = new_run(chapters, "combined")
+        side_run = st.session_state.side_run = new_run(chapters)
+        run_cascade(run, list(range(1, len(chapters) + 1)), "章",
+                   *caption_steps("combined"), keep_captions, reject_captions, side_run)
+        st.session_state.side_captions = side_captions_of(side_run)
     else:
-        st.success("✅ 全チャンク処理完了！")
+        run = st.session_state.caption_run = new_run(caption_spans(parsed), "packed" if use_packing else "chunks")
+        run_cascade(run, list(range(1, len(run["spans"]) + 1)), "チャンク",
+                   *caption_steps(run["kind"]), keep_captions, reject_captions)
+    repair_rejected(run)
+    st.session_state.all_captions = in_timeline_order(run["done"])
+
+    if not run["failed"]:
+        if not st.session_state.all_captions:
+            st.warning("⚠️ 条件を満たすテロップが生成されませんでした。プロンプトや入力を見直してください。")
+        else:
+            st.success("✅ 全チャンク処理完了！")
+
+caption_run = st.session_state.get("caption_run")
+if caption_run and caption_run["failed"]:
+    combined = caption_run["kind"] == "combined"
+    label = "章" if combined else "チャンク"
+    if show_failures(caption_run, label, "captions"):
+        side_run = st.session_state.side_run if combined else None
+        run_cascade(caption_run, sorted(caption_run["failed"]), label,
+                   *caption_steps(caption_run["kind"]), keep_captions, reject_captions, side_run)
+        repair_rejected(caption_run)
+        st.session_state.all_captions = in_timeline_order(caption_run["done"])
+        if combined:
+            st.session_state.side_captions = side_captions_of(side_run)
+        st.rerun()
 
 if st.session_state.all_captions:
     st.subheader("生成されたテロップ案")
     st.json(st.session_state.all_captions)
-    df = pd.DataFrame(st.session_state.all_captions)
-    st.download_button("CSV ダウンロード", df.to_csv(index=False), "captions.csv", "text/csv")
+    st.download_button("CSV ダウンロード", captions_csv(st.session_state.all_captions), "captions.csv", "text/csv")
+    if caption_run:
+        show_model_stats(caption_run)
 
 if st.button("サイドテロップコピーを生成"):
     if not transcript.strip():
@@ -204,88 +697,34 @@ if st.button("サイドテロップコピーを生成"):
 
     st.info("サイドテロップコピー案を生成中…")
 
-    chapters = chunk_by_timestamp(transcript)
-    MAX_CHAPTERS = 8
-    if len(chapters) > MAX_CHAPTERS:
-        chunk_size = len(chapters) // MAX_CHAPTERS
-        merged = []
-        buf = ""
-        for idx, ch in enumerate(chapters, start=1):
-            buf += ch
-            if idx % chunk_size == 0 or idx == len(chapters):
-                merged.append(buf)
-                buf = ""
-        chapters = merged
-
-    side_captions = []
-    for i, chapter in enumerate(chapters):
-        st.write(f"▶ サイドテロップ {i+1}/{len(chapters)} を処理中…")
-
-        prompt_side_caption = f"""
-以下の文字起こし原稿（章）から、視聴者が続きを見たくなるような
-インパクトのある「見出しテロップ」を1つだけ作成してください。
-句読点はすべて半角スペースに置き換え、
-必ず以下の体裁に統一してください。
-
-【テロップフォーマット】
-「キャッチコピー（末尾に！や？などの強調記号）　補足説明」
-（例）
-「痩せるならソバ！　麺類糖質ランキング」
-「糖質制限で痩せる？　簡単ダイエットの裏技」
-
-キャッチコピーの末尾には必ず「！」や「？」「！！」などの強調記号を付けてください。
-補足説明はキャッチコピーの後に半角スペースで区切り、わかりやすく短くまとめてください。
-文字数はキャッチコピー＋補足説明合わせて16文字以上20文字以内に収めてください。
-もし文字数が不足する場合は、キャッチーな一言や強調語を付け足して必ず16文字以上に調整してください。
-また、もし20文字を超える場合は、20文字以内に調整してください。
-
-フォーマットは以下の通りです：
-{{
-"start":"HH:MM:SS:FF",
-"caption":"ここにテロップ"
-}}
-
-章：
-{chapter}
-"""
-        try:
-            resp_side_caption = client.chat.completions.create(
-                model=MODEL,
-                messages=[{"role": "user", "content": prompt_side_caption}],
-                max_tokens=300,
-                temperature=0.7,
-                stream=False
-            )
-            raw = resp_side_caption.choices[0].message.content
-
-            m = re.search(r"```(?:json)?\s*([\s\S]*?)```", raw)
-            clean = m.group(1).strip() if m else raw.strip()
-            clean = "\n".join([ln for ln in clean.splitlines() if ln.strip()])
-
-            try:
-                cap = json.loads(clean)
-                if "start" not in cap:
-                    cap["start"] = "00:00:00:00"
-                caption_text = cap["caption"].replace("。", " ").replace("、", " ")
-                cap["caption"] = caption_text
-                side_captions.append(cap)
-            except json.JSONDecodeError as e:
-                st.error(f"サイドテロップ {i+1} のパース失敗: {e}")
-                st.code(raw, language="json")
-                st.stop()
-
-        except Exception as e:
-            st.error(f"サイドテロップコピー生成中にエラーが発生しました: {e}")
+    chapters = chapter_spans(parsed)
+    run = st.session_state.side_run = new_run(chapters)
+    run_cascade(run, list(range(1, len(chapters) + 1)), "サイドテロップ",
+                build_side_caption_prompt, send_side_caption_prompt, parse_side_caption_response,
+                accept=side_caption_accepted)
+    st.session_state.side_captions = side_captions_of(run)
 
-    st.session_state.side_captions = side_captions
+    if not run["failed"]:
+        if not st.session_state.side_captions:
+            st.warning("⚠️ 条件を満たすサイドテロップが生成されませんでした。")
+        else:
+            st.success("✅ 全章処理完了！")
 
-    if not side_captions:
-        st.warning("⚠️ 条件を満たすサイドテロップが生成されませんでした。")
-    else:
-        st.success("✅ 全章処理完了！")
+side_run = st.session_state.get("side_run")
+if side_run and side_run["failed"]:
+    if show_failures(side_run, "サイドテロップ", "side"):
+        run_cascade(side_run, sorted(side_run["failed"]), "サイドテロップ",
+                    build_side_caption_prompt, send_side_caption_prompt, parse_side_caption_response,
+                    accept=side_caption_accepted)
+        st.session_state.side_captions = side_captions_of(side_run)
+        st.rerun()
 
 if st.session_state.side_captions:
     st.subheader("生成されたサイドテロップ案")
     st.json(st.session_state.side_captions)
-    df = pd.DataFrame(st.session_state.side_captions)
-    st.download_button("CSV ダウンロード", df.to_csv(index=False), "side_captions.csv", "text/csv")
+    st.download_button("CSV ダウンロード", captions_csv(st.session_state.side_captions), "side_captions.csv", "text/csv")
+    if side_run:
+        show_model_stats(side_run)
+
+show_pool_status()
+show_rerun_timing("画面の最後")
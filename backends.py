@@ -0,0 +1,130 @@
+# テロップ生成で使う LLM の呼び出し口
+#   LLM_BACKEND=openai      OpenAI（既定）
+#   LLM_BACKEND=compatible  OPENAI_BASE_URL の OpenAI 互換サーバ（vLLM・Ollama など）
+#   LLM_BACKEND=mock        同じプロセス内でスタブサーバ（mock_server.py）を起動する。課金なしで負荷試験・計測ができる
+from typing import Callable, Mapping, NamedTuple, Optional
+
+from openai import OpenAI
+
+BACKENDS = ("openai", "compatible", "mock")
+
+
+class Cancelled(Exception):
+    # 呼び出し側が応答を要らなくなった（ヘッジの相手が先に返った）ので受信を打ち切った
+    pass
+
+
+class ChatResult(NamedTuple):
+    content: str
+    finish_reason: Optional[str]
+    # usage を返さないサーバでは None（呼び出し側が手元で数える）
+    prompt_tokens: Optional[int]
+    completion_tokens: Optional[int]
+    headers: Mapping[str, str]
+
+
+# ── OpenAI ──
+class OpenAIBackend:
+    name = "openai"
+    # stream_options（ストリーミング時の usage）を送るか。対応していない互換サーバでは外す
+    stream_usage = True
+
+    def __init__(self, client: OpenAI):
+        self.client = client
+
+    @property
+    def label(self) -> str:
+        return self.name
+
+    def complete(
+        self,
+        model: str,
+        messages: list[dict],
+        max_tokens: int,
+        temperature: float,
+        response_format: Optional[dict] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+    ) -> ChatResult:
+        # on_delta を渡すとストリーミングで受け、届いた断片を順に渡す
+        options = {"response_format": response_format} if response_format else {}
+        if on_delta is not None and self.stream_usage:
+            options["stream_options"] = {"include_usage": True}
+        raw_resp = self.client.chat.completions.with_raw_response.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=on_delta is not None,
+            **options,
+        )
+        if on_delta is None:
+            resp = raw_resp.parse()
+            return ChatResult(
+                resp.choices[0].message.content, resp.choices[0].finish_reason,
+                resp.usage.prompt_tokens if resp.usage else None,
+                resp.usage.completion_tokens if resp.usage else None,
+                raw_resp.headers,
+            )
+        parts = []
+        finish_reason = None
+        usage = None
+        for event in raw_resp.parse():
+            usage = getattr(event, "usage", None) or usage
+            if event.choices:
+                finish_reason = event.choices[0].finish_reason or finish_reason
+            delta = event.choices[0].delta.content if event.choices else None
+            if delta:
+                parts.append(delta)
+                on_delta(delta)
+        return ChatResult(
+            "".join(parts), finish_reason,
+            usage.prompt_tokens if usage else None, usage.completion_tokens if usage else None,
+            raw_resp.headers,
+        )
+
+
+# ── OpenAI 互換サーバ ──
+class CompatibleBackend(OpenAIBackend):
+    name = "compatible"
+    stream_usage = False
+
+    @property
+    def label(self) -> str:
+        return f"{self.name}（{self.client.base_url}）"
+
+
+# ── ローカルのスタブサーバ ──
+class MockBackend(OpenAIBackend):
+    name = "mock"
+
+    def __init__(self, state, max_retries: int = 2):
+        import mock_server
+
+        self.server = mock_server.start_server(state)
+        super().__init__(OpenAI(api_key="sk-mock", base_url=mock_server.base_url(self.server), max_retries=max_retries))
+        self.state = state
+
+    @property
+    def label(self) -> str:
+        state = self.state
+        return (f"{self.name}（遅延 {state.latency}秒・σ {state.latency_sigma} / "
+                f"エラー {state.error_rate:.0%} / 途切れ {state.truncate_rate:.0%}）")
+
+
+def make_backend(
+    kind: str, api_key: Optional[str] = None, base_url: Optional[str] = None, mock_options: Optional[dict] = None,
+    max_retries: int = 2,
+) -> OpenAIBackend:
+    # max_retries は SDK 内での再試行回数（同じ接続先に送り直す）
+    if kind == "openai":
+        return OpenAIBackend(OpenAI(api_key=api_key, max_retries=max_retries))
+    if kind == "compatible":
+        if not base_url:
+            raise ValueError("LLM_BACKEND=compatible には OPENAI_BASE_URL が必要です")
+        # ローカルの互換サーバはキーを見ないことが多い
+        return CompatibleBackend(OpenAI(api_key=api_key or "sk-local", base_url=base_url, max_retries=max_retries))
+    if kind == "mock":
+        from mock_server import MockState
+
+        return MockBackend(MockState(**(mock_options or {})), max_retries)
+    raise ValueError(f"未知の LLM_BACKEND: {kind}（{' / '.join(BACKENDS)}）")
@@ -0,0 +1,234 @@
+# アーカイブ動画をまとめて処理するオフライン（Batch API）モード
+#   投入:   python batch.py submit transcripts/*.txt --out batch_out
+#   回収:   python batch.py collect batch_out        （完了までポーリングし、動画ごとに CSV を書き出す）
+#   一括:   python batch.py run transcripts/*.txt --out batch_out
+#   ローカル検証: python mock_server.py & してから --base-url http://127.0.0.1:8765/v1 を付ける
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional
+
+from captions import (
+    CAPTION_SCHEMA, filter_captions, parse_captions, parse_structured_captions, response_format_for, validate_times,
+)
+from prompts import STRUCTURED_CAPTION_INSTRUCTION, build_caption_prompt
+from timecode import FPS
+from transcript import chunk_by_timestamp, parse_transcript, span_text
+
+# ── 定数 ──
+MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+MAX_TOKENS = 2000
+TEMPERATURE = 0.8
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_MAX_REQUESTS = 50000
+POLL_SECONDS = 30
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+MANIFEST = "manifest.json"
+
+
+# ── リクエストの組み立て ──
+def custom_id(video: str, index: int) -> str:
+    return f"{video}#{index}"
+
+
+def split_custom_id(value: str) -> tuple[str, int]:
+    video, _, index = value.rpartition("#")
+    return video, int(index)
+
+
+def chat_body(prompt: str, model: str, output_mode: str) -> dict:
+    # 画面から送るリクエストと同じ形（構造化出力なら system 指示と response_format を添える）
+    body = {"model": model, "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": MAX_TOKENS, "temperature": TEMPERATURE}
+    response_format = response_format_for(output_mode, CAPTION_SCHEMA)
+    if response_format is not None:
+        body["messages"].insert(0, {"role": "system", "content": STRUCTURED_CAPTION_INSTRUCTION})
+        body["response_format"] = response_format
+    return body
+
+
+def iter_batch_requests(
+    videos: dict[str, str], model: str, output_mode: str, fps: int = FPS,
+) -> Iterator[dict]:
+    # 動画ごとに20秒チャンクへ分け、1チャンク＝1リクエストの行にする
+    for video, text in videos.items():
+        table = parse_transcript(text, fps)
+        for i, span in enumerate(chunk_by_timestamp(table), start=1):
+            prompt = build_caption_prompt(span_text(table.text, span))
+            yield {"custom_id": custom_id(video, i), "method": "POST", "url": BATCH_ENDPOINT,
+                   "body": chat_body(prompt, model, output_mode)}
+
+
+def write_batch_files(requests: Iterable[dict], out_dir: Path) -> list[Path]:
+    # 1ファイルあたりのリクエスト数上限を超えたら次のファイルに分ける
+    paths = []
+    f = None
+    count = 0
+    try:
+        for request in requests:
+            if f is None or count >= BATCH_MAX_REQUESTS:
+                if f is not None:
+                    f.close()
+                paths.append(out_dir / f"batch_input_{len(paths) + 1}.jsonl")
+                f = open(paths[-1], "w", encoding="utf-8")
+                count = 0
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+            count += 1
+    finally:
+        if f is not None:
+            f.close()
+    return paths
+
+
+# ── Batch API ──
+def submit_batch(client, path: Path) -> str:
+    with open(path, "rb") as f:
+        uploaded = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(input_file_id=uploaded.id, endpoint=BATCH_ENDPOINT, completion_window="24h")
+    return batch.id
+
+
+def wait_for_batches(
+    client,
+    batch_ids: list[str],
+    poll_seconds: float = POLL_SECONDS,
+    sleep: Callable[[float], None] = time.sleep,
+    on_status: Callable[[object], None] = lambda batch: None,
+) -> list:
+    # すべてのバッチが終了状態になるまでポーリングする
+    finished = {}
+    while True:
+        for batch_id in batch_ids:
+            if batch_id in finished:
+                continue
+            batch = client.batches.retrieve(batch_id)
+            on_status(batch)
+            if batch.status in TERMINAL_STATUSES:
+                finished[batch_id] = batch
+        if len(finished) == len(batch_ids):
+            return [finished[batch_id] for batch_id in batch_ids]
+        sleep(poll_seconds)
+
+
+def iter_batch_results(client, batch) -> Iterator[tuple[str, Optional[str], Optional[str]]]:
+    # (custom_id, 応答本文, エラー内容) を1行ずつ返す。失敗した行は error ファイル側に入っている
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            response = row.get("response") or {}
+            if row.get("error") or response.get("status_code") != 200:
+                error = row.get("error") or response.get("body", {}).get("error") or response.get("status_code")
+                yield row["custom_id"], None, json.dumps(error, ensure_ascii=False)
+            else:
+                yield row["custom_id"], response["body"]["choices"][0]["message"]["content"], None
+
+
+# ── 結果の振り分け（画面と同じパース・フィルタを通す） ──
+def collect_captions(results: Iterable, output_mode: str, fps: int = FPS) -> dict[str, dict]:
+    parse = parse_captions if output_mode == "text" else parse_structured_captions
+    videos = {}
+    for cid, content, error in results:
+        video, index = split_custom_id(cid)
+        run = videos.setdefault(video, {"done": {}, "failed": {}})
+        if error is None:
+            try:
+                run["done"][index] = filter_captions(validate_times(parse(content), fps))
+                continue
+            except Exception as e:
+                error = f"パース失敗: {e}"
+        run["failed"][index] = error
+    return videos
+
+
+def export_csvs(videos: dict[str, dict], chunk_counts: dict[str, int], out_dir: Path) -> None:
+    import pandas as pd
+
+    for video, n_chunks in chunk_counts.items():
+        run = videos.get(video, {"done": {}, "failed": {}})
+        caps = [cap for i in sorted(run["done"]) for cap in run["done"][i]]
+        pd.DataFrame(caps, columns=["start", "end", "caption", "category"]).to_csv(
+            out_dir / f"{video}.csv", index=False,
+        )
+        missing = n_chunks - len(run["done"])
+        print(f"{video}: テロップ {len(caps)} 件 / チャンク {len(run['done'])}/{n_chunks} 完了"
+              + (f"（失敗 {missing} 件）" if missing else ""))
+        for i in sorted(run["failed"]):
+            print(f"  チャンク {i}: {run['failed'][i]}")
+
+
+# ── コマンド ──
+def make_client(base_url: Optional[str]):
+    from dotenv import load_dotenv
+    from openai import OpenAI
+
+    load_dotenv()
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY", "sk-local"), base_url=base_url)
+
+
+def submit(client, files: list[str], out_dir: Path, model: str, output_mode: str, fps: int) -> dict:
+    videos = {Path(f).stem: Path(f).read_text(encoding="utf-8") for f in files}
+    if len(videos) != len(files):
+        raise SystemExit("ファイル名（拡張子なし）が重複しています。")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    chunk_counts = {}
+
+    def counted(requests):
+        for request in requests:
+            video, _ = split_custom_id(request["custom_id"])
+            chunk_counts[video] = chunk_counts.get(video, 0) + 1
+            yield request
+
+    paths = write_batch_files(counted(iter_batch_requests(videos, model, output_mode, fps)), out_dir)
+    manifest = {
+        "model": model, "output_mode": output_mode, "fps": fps, "chunks": chunk_counts,
+        "batches": [submit_batch(client, path) for path in paths],
+    }
+    (out_dir / MANIFEST).write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"{len(videos)} 本・{sum(chunk_counts.values())} チャンクを {len(paths)} バッチで投入しました。")
+    return manifest
+
+
+def collect(client, out_dir: Path, poll_seconds: float) -> None:
+    manifest = json.loads((out_dir / MANIFEST).read_text(encoding="utf-8"))
+
+    def show(batch):
+        counts = batch.request_counts
+        done = f"{counts.completed + counts.failed}/{counts.total}" if counts else "-"
+        print(f"{batch.id}: {batch.status}（{done}）")
+
+    batches = wait_for_batches(client, manifest["batches"], poll_seconds, on_status=show)
+    results = (row for batch in batches for row in iter_batch_results(client, batch))
+    videos = collect_captions(results, manifest["output_mode"], manifest["fps"])
+    export_csvs(videos, manifest["chunks"], out_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="テロップ生成を Batch API でまとめて実行する")
+    parser.add_argument("command", choices=["submit", "collect", "run"])
+    parser.add_argument("paths", nargs="+", help="submit/run: 文字起こしファイル、collect: 出力フォルダ")
+    parser.add_argument("--out", default="batch_out")
+    parser.add_argument("--model", default=MODEL)
+    parser.add_argument("--output-mode", choices=["json_object", "json_schema", "text"], default="json_object")
+    parser.add_argument("--fps", type=int, default=FPS)
+    parser.add_argument("--poll", type=float, default=POLL_SECONDS, help="完了確認の間隔（秒）")
+    parser.add_argument("--base-url", default=os.getenv("OPENAI_BASE_URL"))
+    args = parser.parse_args()
+
+    client = make_client(args.base_url)
+    if args.command == "collect":
+        collect(client, Path(args.paths[0]), args.poll)
+        return
+    out_dir = Path(args.out)
+    submit(client, args.paths, out_dir, args.model, args.output_mode, args.fps)
+    if args.command == "run":
+        collect(client, out_dir, args.poll)
+
+
+if __name__ == "__main__":
+    main()
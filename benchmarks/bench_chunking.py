@@ -0,0 +1,106 @@
+# 3時間尺の文字起こしで chunk_by_timestamp の処理時間とピークメモリを旧実装と比較する
+#   実行: python -m benchmarks.bench_chunking [--hours 3] [--chunk-seconds 20]
+import argparse
+import random
+import re
+import time
+import tracemalloc
+from datetime import timedelta
+
+from transcript import chunk_by_timestamp, parse_transcript, span_text
+
+
+# ── 旧実装（比較用にそのまま残す） ──
+def legacy_parse_timecode(timecode: str) -> timedelta:
+    h, m, s = map(int, timecode.split(":"))
+    return timedelta(hours=h, minutes=m, seconds=s)
+
+
+def legacy_chunk_by_timestamp(text: str, max_seconds: int = 20) -> list[str]:
+    lines = text.splitlines(keepends=True)
+    chunks = []
+    buf = ""
+    start_time = None
+
+    for line in lines:
+        match = re.match(r'^(\d{2}:\d{2}:\d{2})', line)
+        if match:
+            current_time = legacy_parse_timecode(match.group(1))
+            if start_time is None:
+                start_time = current_time
+            else:
+                duration = current_time - start_time
+                if duration.total_seconds() >= max_seconds:
+                    chunks.append(buf)
+                    buf = ""
+                    start_time = current_time
+            buf += line
+        else:
+            buf += line
+    if buf:
+        chunks.append(buf)
+    return chunks
+
+
+# ── ダミー原稿生成 ──
+def make_transcript(hours: float, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    words = ["糖質", "ダイエット", "麺類", "ランキング", "今日は", "ですね", "ポイント", "注意", "簡単", "おすすめ"]
+    lines = []
+    t = 0
+    end = int(hours * 3600)
+    while t < end:
+        h, rem = divmod(t, 3600)
+        m, s = divmod(rem, 60)
+        lines.append(f"{h:02d}:{m:02d}:{s:02d}\n")
+        for _ in range(rng.randint(1, 2)):
+            lines.append("".join(rng.choice(words) for _ in range(rng.randint(8, 20))) + "\n")
+        t += rng.randint(2, 6)
+    return "".join(lines)
+
+
+def chunk_spans(text: str, max_seconds: int = 20):
+    # 取り込み（セグメント表の構築）込みで計測する
+    return chunk_by_timestamp(parse_transcript(text), max_seconds)
+
+
+def measure(fn, *args, repeat: int = 5):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hours", type=float, default=3)
+    parser.add_argument("--chunk-seconds", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    text = make_transcript(args.hours)
+    print(f"原稿: {args.hours}時間 / {len(text):,} 文字 / {text.count(chr(10)):,} 行 / 分割 {args.chunk_seconds}秒")
+
+    # 結果が一致することを先に確認
+    legacy = legacy_chunk_by_timestamp(text, args.chunk_seconds)
+    spans = chunk_spans(text, args.chunk_seconds)
+    assert legacy == [span_text(text, sp) for sp in spans], "チャンク結果が旧実装と一致しません"
+
+    rows = [
+        ("legacy (buf += line)", measure(legacy_chunk_by_timestamp, text, args.chunk_seconds, repeat=args.repeat)),
+        ("spans (segment table)", measure(chunk_spans, text, args.chunk_seconds, repeat=args.repeat)),
+    ]
+    print(f"{'実装':<24}{'時間(ms)':>12}{'ピーク(KiB)':>14}")
+    for name, (sec, peak) in rows:
+        print(f"{name:<24}{sec * 1000:>12.2f}{peak / 1024:>14.1f}")
+    print(f"チャンク数: {len(spans)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+# タイムコード処理のマイクロベンチマーク（旧 parse_timecode＋timedelta と整数ミリ秒の比較）
+#   実行: python -m benchmarks.bench_timecode [--n 100000]
+import argparse
+import re
+import timeit
+from datetime import timedelta
+
+from timecode import HMS_RE, hms_to_ms, parse_ms
+
+
+# ── 旧実装（比較用にそのまま残す） ──
+def legacy_parse_timecode(timecode: str) -> timedelta:
+    h, m, s = map(int, timecode.split(":"))
+    return timedelta(hours=h, minutes=m, seconds=s)
+
+
+def legacy_duration_check(line: str, start_time: timedelta) -> bool:
+    match = re.match(r'^(\d{2}:\d{2}:\d{2})', line)
+    current_time = legacy_parse_timecode(match.group(1))
+    return (current_time - start_time).total_seconds() >= 20
+
+
+# ── 整数ミリ秒 ──
+def int_duration_check(line: str, start_ms: int) -> bool:
+    g = HMS_RE.match(line).groups()
+    return hms_to_ms(int(g[0]), int(g[1]), int(g[2])) - start_ms >= 20000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=100000)
+    args = parser.parse_args()
+
+    line = "01:23:45 今日は糖質制限のお話です\n"
+    start_td = timedelta(hours=1, minutes=23, seconds=20)
+    start_ms = hms_to_ms(1, 23, 20)
+    assert legacy_duration_check(line, start_td) == int_duration_check(line, start_ms)
+
+    rows = [
+        ("legacy 行判定 (re.match + timedelta)", lambda: legacy_duration_check(line, start_td)),
+        ("int 行判定 (コンパイル済み + ms)", lambda: int_duration_check(line, start_ms)),
+        ("legacy parse_timecode", lambda: legacy_parse_timecode("01:23:45")),
+        ("parse_ms (HH:MM:SS)", lambda: parse_ms("01:23:45")),
+        ("parse_ms (HH:MM:SS:FF)", lambda: parse_ms("01:23:45:12")),
+    ]
+    print(f"{'処理':<40}{'ns/回':>10}")
+    for name, fn in rows:
+        sec = min(timeit.repeat(fn, number=args.n, repeat=5))
+        print(f"{name:<40}{sec / args.n * 1e9:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
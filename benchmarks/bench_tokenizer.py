@@ -0,0 +1,82 @@
+# 起動直後に最初のトークン数を出すまでの時間を比較する
+#   キャッシュあり（tokenizer.py seed 済みの tiktoken_cache/）・キャッシュなしで概算・キャッシュなしで tiktoken が毎回ダウンロード
+#   実行: python -m benchmarks.bench_tokenizer [--model gpt-3.5-turbo] [--repeat 5]
+#   各回を新しいプロセスで測る（lru_cache や tiktoken 内部のキャッシュが効かない起動直後の状態）。
+#   キャッシュありの行は seed 済みであること、ダウンロードの行はネットワークがあることが前提（無ければ「失敗」）
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+from tokenizer import TIKTOKEN_CACHE_DIR, encoding_name, is_cached
+
+ROOT = Path(__file__).resolve().parent.parent
+# import だけ（遅延読み込みなのでエンコーディングには触れない）と、最初の1回を数えるまで
+SNIPPET = """
+import time
+t0 = time.perf_counter()
+import tokenizer
+t1 = time.perf_counter()
+{count}("糖質を抑えると体重が減りやすくなります")
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t0)
+"""
+# アプリと同じ経路（無ければ概算）と、ガードを通さず tiktoken に取得させる経路
+COUNT_APP = "tokenizer.token_counter({model!r})"
+COUNT_DOWNLOAD = "__import__('tiktoken').get_encoding(tokenizer.encoding_name({model!r})).encode"
+
+
+def run_once(model: str, cache_dir: str, count: str) -> tuple[float, float]:
+    proc = subprocess.run(
+        [sys.executable, "-c", SNIPPET.format(count=count.format(model=model))],
+        cwd=ROOT, env=dict(os.environ, TIKTOKEN_CACHE_DIR=cache_dir), capture_output=True, text=True, timeout=120,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    import_s, first_s = map(float, proc.stdout.split())
+    return import_s, first_s
+
+
+def measure(model: str, cache_dir: Optional[str], count: str, repeat: int) -> tuple[float, float]:
+    # cache_dir が None なら毎回空のフォルダから始める（取得したファイルを次の回に持ち越さない）
+    runs = []
+    for _ in range(repeat):
+        if cache_dir is None:
+            with tempfile.TemporaryDirectory() as empty:
+                runs.append(run_once(model, empty, count))
+        else:
+            runs.append(run_once(model, cache_dir, count))
+    return statistics.median(r[0] for r in runs), statistics.median(r[1] for r in runs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=os.getenv("OPENAI_MODEL", "gpt-3.5-turbo"))
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"モデル: {args.model}（{encoding_name(args.model)}） / キャッシュ: {TIKTOKEN_CACHE_DIR}")
+    if not is_cached(args.model):
+        print(f"  ※ キャッシュ未作成です。先に `python tokenizer.py seed --model {args.model}` を実行してください。")
+
+    print(f"{'条件':<28}{'import(ms)':>12}{'初回計数(ms)':>14}")
+    cases = [
+        ("キャッシュあり", str(TIKTOKEN_CACHE_DIR), COUNT_APP),
+        ("キャッシュなし（概算）", None, COUNT_APP),
+        ("キャッシュなし（毎回取得）", None, COUNT_DOWNLOAD),
+    ]
+    for label, cache_dir, count in cases:
+        try:
+            import_s, first_s = measure(args.model, cache_dir, count, args.repeat)
+        except Exception as e:
+            print(f"{label:<28}{'失敗':>12}  {e}")
+            continue
+        print(f"{label:<28}{import_s * 1000:>12.1f}{first_s * 1000:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
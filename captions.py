@@ -0,0 +1,324 @@
+import json
+import re
+from bisect import bisect_right
+from typing import NamedTuple, Optional, Sequence
+
+from timecode import FPS, format_hms, parse_ms
+
+FENCE_RE = re.compile(r"```(?:json)?\s*([\s\S]*?)```")
+CATEGORIES = ["positive", "negative", "neutral", "point"]
+
+# ── 構造化出力のスキーマ（response_format の json_schema に渡す） ──
+CAPTION_LIST_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "start": {"type": "string", "description": "HH:MM:SS"},
+            "end": {"type": "string", "description": "HH:MM:SS"},
+            "caption": {"type": "string"},
+            "category": {"type": "string", "enum": CATEGORIES},
+        },
+        "required": ["start", "end", "caption", "category"],
+        "additionalProperties": False,
+    },
+}
+
+CAPTION_SCHEMA = {
+    "name": "captions",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {"captions": CAPTION_LIST_SCHEMA},
+        "required": ["captions"],
+        "additionalProperties": False,
+    },
+}
+
+# 複数チャンクをまとめた依頼の応答（チャンク番号ごとにテロップを返す）
+PACKED_CAPTION_SCHEMA = {
+    "name": "packed_captions",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "chunks": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {"chunk_id": {"type": "integer"}, "captions": CAPTION_LIST_SCHEMA},
+                    "required": ["chunk_id", "captions"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["chunks"],
+        "additionalProperties": False,
+    },
+}
+
+SIDE_CAPTION_OBJECT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "start": {"type": "string", "description": "HH:MM:SS:FF"},
+        "caption": {"type": "string"},
+    },
+    "required": ["start", "caption"],
+    "additionalProperties": False,
+}
+
+SIDE_CAPTION_SCHEMA = {
+    "name": "side_caption",
+    "strict": True,
+    "schema": SIDE_CAPTION_OBJECT_SCHEMA,
+}
+
+# テロップと章の見出し（サイドテロップ）を1回で返す応答
+COMBINED_SCHEMA = {
+    "name": "combined_captions",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {"captions": CAPTION_LIST_SCHEMA, "side_caption": SIDE_CAPTION_OBJECT_SCHEMA},
+        "required": ["captions", "side_caption"],
+        "additionalProperties": False,
+    },
+}
+
+
+# ── レスポンス整形 ──
+def strip_code_fence(raw: str) -> str:
+    m = FENCE_RE.search(raw)
+    clean = m.group(1).strip() if m else raw.strip()
+    return "\n".join([ln for ln in clean.splitlines() if ln.strip()])
+
+
+def parse_captions(raw: str) -> list[dict]:
+    # パースできない場合は json.JSONDecodeError、テロップの配列でなければ ValueError を投げる（どちらも再試行される）
+    return _checked_captions(json.loads(strip_code_fence(raw)), strict=False)
+
+
+def parse_side_caption(raw: str) -> list[dict]:
+    cap = json.loads(strip_code_fence(raw))
+    cap["caption"] = cap["caption"].replace("。", " ").replace("、", " ")
+    return [cap]
+
+
+def response_format_for(output_mode: str, schema: dict) -> Optional[dict]:
+    # output_mode は "json_schema" / "json_object" / "text"（従来の抜き出し）
+    if output_mode == "json_schema":
+        return {"type": "json_schema", "json_schema": schema}
+    if output_mode == "json_object":
+        return {"type": "json_object"}
+    return None
+
+
+# ── 構造化出力のパース（整形はせず、スキーマに合わなければすぐ失敗させる） ──
+def parse_structured_captions(raw: str) -> list[dict]:
+    data = json.loads(raw)
+    return _checked_captions(data.get("captions") if isinstance(data, dict) else None)
+
+
+def parse_packed_captions(raw: str) -> dict[int, list[dict]]:
+    # {"chunks": [{"chunk_id": 3, "captions": [...]}, ...]} をチャンク番号ごとの辞書にする
+    data = json.loads(raw)
+    chunks = data.get("chunks") if isinstance(data, dict) else None
+    if not isinstance(chunks, list):
+        raise ValueError("chunks 配列がありません")
+    packed = {}
+    for chunk in chunks:
+        if not (isinstance(chunk, dict) and isinstance(chunk.get("chunk_id"), int)):
+            raise ValueError(f"chunk_id がありません: {chunk}")
+        packed.setdefault(chunk["chunk_id"], []).extend(_checked_captions(chunk.get("captions")))
+    return packed
+
+
+def is_caption_shaped(cap) -> bool:
+    # 従来の抜き出しで受け付ける形。end・category の欠けや未知のカテゴリは後段（時刻検証・フィルタ）に任せる
+    return (
+        isinstance(cap, dict)
+        and all(isinstance(cap.get(k), str) for k in ("start", "caption"))
+        and all(isinstance(cap.get(k, ""), str) for k in ("end", "category"))
+    )
+
+
+def _checked_captions(caps, strict: bool = True) -> list[dict]:
+    # strict はスキーマどおり（構造化出力）、そうでなければ is_caption_shaped の形だけを確かめる
+    if not isinstance(caps, list):
+        raise ValueError("captions 配列がありません")
+    for cap in caps:
+        if strict:
+            ok = (
+                isinstance(cap, dict)
+                and all(isinstance(cap.get(k), str) for k in ("start", "end", "caption"))
+                and cap.get("category") in CATEGORIES
+            )
+        else:
+            ok = is_caption_shaped(cap)
+        if not ok:
+            raise ValueError(f"スキーマに合わないテロップです: {cap}")
+    return caps
+
+
+def parse_structured_side_caption(raw: str) -> list[dict]:
+    return _checked_side_caption(json.loads(raw))
+
+
+class CombinedCaptions(NamedTuple):
+    # まとめ生成の応答。captions はテロップ、side は章の見出し（サイドテロップ）1件
+    captions: list
+    side: list
+
+
+def parse_combined_captions(raw: str) -> CombinedCaptions:
+    data = json.loads(raw)
+    if not isinstance(data, dict):
+        raise ValueError("JSON オブジェクトではありません")
+    return CombinedCaptions(_checked_captions(data.get("captions")), _checked_side_caption(data.get("side_caption")))
+
+
+def _checked_side_caption(cap) -> list[dict]:
+    if not (isinstance(cap, dict) and isinstance(cap.get("caption"), str)):
+        raise ValueError(f"スキーマに合わないサイドテロップです: {cap}")
+    cap["caption"] = cap["caption"].replace("。", " ").replace("、", " ")
+    return [cap]
+
+
+# ── ストリーミング応答の逐次パース ──
+class JsonObjectStream:
+    # 届いた断片を順に読み、配列要素のオブジェクトが閉じた時点で1件ずつ返す。
+    # コードフェンスや前置きの文章はオブジェクトの外側なので読み飛ばされる。
+    # level は要素オブジェクトの外側にある { の数（{"captions": [...]} なら 1）
+    def __init__(self, level: int = 0):
+        self.level = level
+        self.text = ""
+        self.pos = 0
+        self.start = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, chunk: str) -> list[dict]:
+        text = self.text = self.text + chunk
+        items = []
+        for i in range(self.pos, len(text)):
+            ch = text[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = self.depth > 0
+            elif ch == "{":
+                if self.depth == self.level:
+                    self.start = i
+                self.depth += 1
+            elif ch == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == self.level:
+                    try:
+                        items.append(json.loads(text[self.start:i + 1]))
+                    except json.JSONDecodeError:
+                        pass
+        # 読み終えた部分は捨てて、途中のオブジェクトだけ残す
+        if self.depth <= self.level:
+            self.text, self.pos = "", 0
+        else:
+            self.text, self.pos = text[self.start:], len(text) - self.start
+            self.start = 0
+        return items
+
+
+# ── タイムコード検証 ──
+def validate_times(caps: list[dict], fps: int = FPS) -> list[dict]:
+    # 開始時刻が読めないテロップは落とし、終了時刻が無い・開始より前なら開始時刻に揃える
+    valid = []
+    for cap in caps:
+        start_ms = parse_ms(str(cap.get("start", "")), fps)
+        if start_ms is None:
+            continue
+        end_ms = parse_ms(str(cap.get("end", "")), fps)
+        if end_ms is None or end_ms < start_ms:
+            end_ms = start_ms
+        cap["start"] = format_hms(start_ms)
+        cap["end"] = format_hms(end_ms)
+        valid.append(cap)
+    return valid
+
+
+# ── カテゴリ・文字数フィルタ ──
+SHORT_CATEGORIES = ["positive", "negative", "neutral"]
+
+RULE_SHORT_LENGTH = "17文字以内に収める"
+RULE_POINT_LENGTH = "15文字以上40文字未満の説明文にする"
+RULE_POINT_ENDING = "文末を「です」または「ます」で終える"
+RULE_POINT_REPEAT = "直前もpointのため、positive/negative/neutral のいずれか（17文字以内）に書き換える"
+RULE_CATEGORY = "category を positive/negative/neutral/point のいずれかにする"
+
+
+def screen_captions(caps: list[dict]) -> tuple[list[dict], list[dict]]:
+    # 条件を満たすテロップと、満たさないテロップ（違反したルールを violations に付ける）に分ける
+    filtered_caps = []
+    rejected_caps = []
+    last_category = ""
+    for cap in caps:
+        caption_text = cap.get("caption", "")
+        category = cap.get("category", "").lower()
+        caption_length = len(caption_text)
+
+        caption_text = caption_text.replace("。", " ").replace("、", " ")
+
+        violations = []
+        if category in SHORT_CATEGORIES:
+            if caption_length > 17:
+                violations.append(RULE_SHORT_LENGTH)
+        elif category == "point":
+            if not 15 <= caption_length < 40:
+                violations.append(RULE_POINT_LENGTH)
+            if not (caption_text.endswith("です") or caption_text.endswith("ます")):
+                violations.append(RULE_POINT_ENDING)
+            if not violations and last_category == "point":
+                violations.append(RULE_POINT_REPEAT)
+        else:
+            violations.append(RULE_CATEGORY)
+
+        if violations:
+            rejected_caps.append({**cap, "violations": violations})
+        else:
+            cap["caption"] = caption_text
+            filtered_caps.append(cap)
+            last_category = category
+    return filtered_caps, rejected_caps
+
+
+def filter_captions(caps: list[dict]) -> list[dict]:
+    return screen_captions(caps)[0]
+
+
+def rejected_captions(caps: list[dict]) -> list[dict]:
+    return screen_captions(caps)[1]
+
+
+# ── 書き直したテロップの差し込み ──
+def insert_repaired(
+    done: dict[int, list[dict]], chunk_starts: Sequence[int], repaired: list[dict], fps: int = FPS,
+) -> int:
+    # 開始時刻からチャンクを引き、書き直し分だけを前後のテロップと並べてフィルタに通す。
+    # 採用済みのテロップは入れ替えない（前後どちらかが通らなくなる書き直しは捨てる）。差し込んだ件数を返す
+    restored = 0
+    for cap in sorted(repaired, key=lambda cap: cap["start"]):
+        i = max(1, bisect_right(chunk_starts, parse_ms(cap["start"], fps)))
+        if i not in done:
+            continue
+        caps = done[i]
+        pos = sum(1 for other in caps if other["start"] <= cap["start"])
+        window = [dict(other) for other in caps[max(0, pos - 1):pos]] + [dict(cap)]
+        at = len(window) - 1
+        window += [dict(other) for other in caps[pos:pos + 1]]
+        if len(filter_captions(window)) == len(window):
+            caps.insert(pos, window[at])
+            restored += 1
+    return restored
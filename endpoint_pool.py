@@ -0,0 +1,229 @@
+# 複数の接続先（API キー・OpenAI 互換サーバ）への振り分け
+#   LLM_POOL に JSON の配列（またはその JSON ファイルのパス）を渡す:
+#   [{"name": "org-a", "api_key_env": "OPENAI_API_KEY_A", "weight": 2, "rpm": 3500, "tpm": 90000},
+#    {"name": "gpu1", "kind": "compatible", "base_url": "http://gpu1:8000/v1", "weight": 1}]
+#   レート制限の空きがすぐある接続先のうち、送信中トークン÷重みが最も少ないものに送る（どこにも空きが無ければ
+#   待ち時間の最も短いところで待つ）。429・5xx・接続エラーなら次の接続先へ切り替える
+import json
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Callable, Optional
+
+import openai
+
+from backends import Cancelled, ChatResult, OpenAIBackend
+from ratelimit import RateLimiter
+
+COOLDOWN_BASE = 1.0
+COOLDOWN_MAX = 30.0
+THROUGHPUT_WINDOW = 60.0
+
+
+def is_failover_error(e: Exception) -> bool:
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return isinstance(e, openai.APIConnectionError)
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    response = getattr(e, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+# ── 接続先1件ぶんの状態 ──
+class Endpoint:
+    def __init__(self, name: str, backend: OpenAIBackend, weight: float = 1.0, limiter: Optional[RateLimiter] = None):
+        self.name = name
+        self.backend = backend
+        self.weight = weight
+        self.limiter = limiter
+        # レート制限の空き待ちも含めて、この接続先に割り当て済みのトークン数
+        self.outstanding_tokens = 0
+        self.queued = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.seconds = 0.0
+        self.last_error = ""
+        # 直近 THROUGHPUT_WINDOW 秒に完了した (時刻, トークン数)
+        self.recent: deque[tuple[float, int]] = deque()
+
+    def load(self, tokens: int) -> float:
+        return (self.outstanding_tokens + tokens) / self.weight
+
+
+# ── プール ──
+class EndpointPool:
+    # OpenAIBackend と同じ complete() を持ち、呼び出しごとに接続先を選ぶ
+    def __init__(self, endpoints: list[Endpoint], clock: Callable[[], float] = time.monotonic):
+        if not endpoints:
+            raise ValueError("接続先が1件もありません")
+        self.endpoints = endpoints
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.failovers = 0
+
+    @property
+    def label(self) -> str:
+        if len(self.endpoints) == 1:
+            return self.endpoints[0].backend.label
+        return f"{len(self.endpoints)} 件のプール（{' / '.join(e.name for e in self.endpoints)}）"
+
+    def reserve(self, tokens: int, tried: list[Endpoint]) -> Optional[Endpoint]:
+        # まだ試していない接続先を1つ選び、選んだ時点で送信中として数える（レート制限の空き待ちの間も負荷に入る）。
+        # 休止中でないものを、レート制限の待ち時間 → 負荷の順に比べる。休止中のものは最後の手段として復帰の早い順
+        now = self.clock()
+
+        def rank(e: Endpoint) -> tuple:
+            if e.cooldown_until > now:
+                return (1, e.cooldown_until, 0.0, 0.0)
+            wait = e.limiter.wait_time(tokens) if e.limiter is not None else 0.0
+            return (0, wait, e.load(tokens), e.calls / e.weight)
+
+        with self.lock:
+            options = [e for e in self.endpoints if e not in tried]
+            if not options:
+                return None
+            endpoint = min(options, key=rank)
+            endpoint.outstanding_tokens += tokens
+            endpoint.queued += 1
+        return endpoint
+
+    def complete(
+        self,
+        model: str,
+        messages: list[dict],
+        max_tokens: int,
+        temperature: float,
+        response_format: Optional[dict] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+        tokens: int = 0,
+    ) -> ChatResult:
+        # tokens は送信中として数える見込み（プロンプト＋max_tokens）。レート制限の予約にも使う
+        emitted = False
+
+        def forward(delta: str) -> None:
+            nonlocal emitted
+            emitted = True
+            on_delta(delta)
+
+        error = None
+        tried = []
+        while True:
+            endpoint = self.reserve(tokens, tried)
+            if endpoint is None:
+                raise error
+            tried.append(endpoint)
+            if error is not None:
+                with self.lock:
+                    self.failovers += 1
+            if endpoint.limiter is not None:
+                endpoint.limiter.acquire(tokens)
+            with self.lock:
+                endpoint.queued -= 1
+                endpoint.in_flight += 1
+            started = self.clock()
+            try:
+                result = endpoint.backend.complete(
+                    model, messages, max_tokens, temperature, response_format,
+                    forward if on_delta is not None else None,
+                )
+            except Exception as e:
+                self._finish(endpoint, tokens, started, error=e)
+                # 本文が届き始めてからの失敗は切り替えない（届いた分が二重に表示されるため）
+                if emitted or not is_failover_error(e):
+                    raise
+                error = e
+                continue
+            if endpoint.limiter is not None:
+                endpoint.limiter.update_from_headers(result.headers)
+            self._finish(endpoint, tokens, started, completion_tokens=result.completion_tokens or 0)
+            return result
+
+    def _finish(
+        self, endpoint: Endpoint, tokens: int, started: float,
+        completion_tokens: int = 0, error: Optional[Exception] = None,
+    ) -> None:
+        now = self.clock()
+        with self.lock:
+            endpoint.outstanding_tokens -= tokens
+            endpoint.in_flight -= 1
+            endpoint.calls += 1
+            endpoint.seconds += now - started
+            if error is None:
+                endpoint.consecutive_failures = 0
+                endpoint.recent.append((now, completion_tokens))
+            elif not isinstance(error, Cancelled):
+                endpoint.failures += 1
+                endpoint.last_error = f"{type(error).__name__}: {error}"[:120]
+                if is_failover_error(error):
+                    # 429 は Retry-After に従い、それ以外は連続失敗の回数に応じて休ませる
+                    endpoint.consecutive_failures += 1
+                    wait = retry_after(error)
+                    if wait is None:
+                        wait = min(COOLDOWN_MAX, COOLDOWN_BASE * 2 ** (endpoint.consecutive_failures - 1))
+                    endpoint.cooldown_until = now + wait
+
+    def rows(self) -> list[dict]:
+        now = self.clock()
+        rows = []
+        with self.lock:
+            for e in self.endpoints:
+                while e.recent and e.recent[0][0] < now - THROUGHPUT_WINDOW:
+                    e.recent.popleft()
+                cooling = e.cooldown_until - now
+                rows.append({
+                    "接続先": e.name,
+                    "重み": e.weight,
+                    "状態": f"休止中（あと {cooling:.0f}秒）" if cooling > 0 else "正常",
+                    "レート待ち": e.queued,
+                    "送信中": e.in_flight,
+                    "送信中トークン": e.outstanding_tokens,
+                    "呼び出し": e.calls,
+                    "失敗": e.failures,
+                    "平均レイテンシ（秒）": round(e.seconds / e.calls, 2) if e.calls else None,
+                    "直近1分の出力トークン": sum(t for _, t in e.recent),
+                    "直近のエラー": e.last_error,
+                })
+        return rows
+
+
+# ── 設定 ──
+def load_pool_config(value: str) -> list[dict]:
+    # JSON の配列そのものか、それを書いたファイルのパス
+    text = value if value.lstrip().startswith("[") else Path(value).read_text(encoding="utf-8")
+    entries = json.loads(text)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("LLM_POOL は接続先の配列にしてください")
+    return entries
+
+
+def make_pool(
+    entries: list[dict], make_backend: Callable[..., OpenAIBackend], default_limits: tuple[int, int],
+) -> EndpointPool:
+    # 切り替えはプール側で行うので、各クライアント内での再試行は切る。
+    # OpenAI のキーは組織ごとの上限があるので、rpm/tpm を省いても既定値（RATE_LIMIT_RPM/TPM）で制限する。
+    # 互換サーバ・mock は rpm/tpm を書いたときだけ制限する
+    endpoints = []
+    for i, entry in enumerate(entries, start=1):
+        kind = entry.get("kind", "openai")
+        api_key = entry.get("api_key") or os.getenv(entry.get("api_key_env", "OPENAI_API_KEY"))
+        name = entry.get("name", f"{kind}-{i}")
+        weight = float(entry.get("weight", 1))
+        if not weight > 0:
+            raise ValueError(f"LLM_POOL の接続先 {name} の weight は正の数にしてください（{entry['weight']}）")
+        backend = make_backend(kind, api_key, entry.get("base_url"), entry.get("mock"), max_retries=0)
+        limiter = None
+        if kind == "openai" or "rpm" in entry or "tpm" in entry:
+            limiter = RateLimiter(entry.get("rpm", default_limits[0]), entry.get("tpm", default_limits[1]))
+        endpoints.append(Endpoint(name, backend, weight, limiter))
+    return EndpointPool(endpoints)
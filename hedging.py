@@ -0,0 +1,162 @@
+# 遅いリクエストのヘッジ（複製送信）
+#   応答が直近の p90 レイテンシを過ぎても返ってこないとき、同じリクエストをもう1件送り、先に返った方を使う。
+#   ストリーミングでは最初の断片が届くまでの時間で判定し、先に断片を出した方が以降の表示を受け持つ。
+#   複製の数は全リクエストの budget 割合までに抑える
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Optional
+
+from backends import Cancelled, ChatResult
+from model_stats import model_price
+
+HEDGE_MIN_SAMPLES = 10
+HEDGE_WINDOW = 200
+
+
+class _Attempt:
+    def __init__(self, hedge: bool):
+        self.hedge = hedge
+        self.started = time.monotonic()
+        # ストリーミングなら最初の断片、そうでなければ応答全体が届いた時点で立てる
+        self.responded = threading.Event()
+
+
+class Hedger:
+    # complete は EndpointPool.complete と同じ引数を取る関数（プールなら複製は空いている接続先へ行く）
+    def __init__(
+        self, complete: Callable[..., ChatResult], budget: float = 0.1,
+        min_samples: int = HEDGE_MIN_SAMPLES, window: int = HEDGE_WINDOW, max_workers: int = 64,
+    ):
+        self.inner = complete
+        self.budget = budget
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        # (モデル, ストリーミングか) ごとの直近のレイテンシ
+        self.latencies: dict[tuple[str, bool], deque[float]] = {}
+        self.window = window
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.extra_tokens: dict[str, list[int]] = {}
+
+    def threshold(self, model: str, streaming: bool) -> Optional[float]:
+        with self.lock:
+            samples = list(self.latencies.get((model, streaming), ()))
+        if len(samples) < self.min_samples:
+            return None
+        return statistics.quantiles(samples, n=10)[-1]
+
+    def _record_latency(self, model: str, streaming: bool, seconds: float) -> None:
+        with self.lock:
+            self.latencies.setdefault((model, streaming), deque(maxlen=self.window)).append(seconds)
+
+    def _take_budget(self) -> bool:
+        with self.lock:
+            if self.hedged + 1 > self.budget * self.requests:
+                return False
+            self.hedged += 1
+            return True
+
+    def complete(
+        self,
+        model: str,
+        messages: list[dict],
+        max_tokens: int,
+        temperature: float,
+        response_format: Optional[dict] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+        tokens: int = 0,
+    ) -> ChatResult:
+        streaming = on_delta is not None
+        with self.lock:
+            self.requests += 1
+        owner = []
+        futures = {}
+
+        def run(attempt: _Attempt) -> ChatResult:
+            def forward(delta: str) -> None:
+                # 先に断片を出した方だけが表示を受け持ち、もう一方はここで打ち切る
+                with self.lock:
+                    if not owner:
+                        owner.append(attempt)
+                if owner[0] is not attempt:
+                    raise Cancelled("ヘッジの相手が先に応答しました")
+                if not attempt.responded.is_set():
+                    self._record_latency(model, True, time.monotonic() - attempt.started)
+                    attempt.responded.set()
+                on_delta(delta)
+
+            try:
+                result = self.inner(
+                    model, messages, max_tokens, temperature, response_format,
+                    forward if streaming else None, tokens,
+                )
+            finally:
+                attempt.responded.set()
+            if not streaming:
+                self._record_latency(model, False, time.monotonic() - attempt.started)
+            return result
+
+        def launch(hedge: bool):
+            attempt = _Attempt(hedge)
+            futures[self.pool.submit(run, attempt)] = attempt
+            return attempt
+
+        primary = launch(False)
+        threshold = self.threshold(model, streaming)
+        if threshold is not None and not primary.responded.wait(threshold) and self._take_budget():
+            launch(True)
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # 複製側が打ち切られただけ、または片方だけの失敗なら、もう一方を待つ
+                    if error is None or isinstance(error, Cancelled):
+                        error = e
+                    continue
+                if futures[future].hedge:
+                    with self.lock:
+                        self.hedge_wins += 1
+                for other in pending:
+                    other.add_done_callback(lambda f: self._count_loser(model, f, result))
+                if len(futures) > 1 and not pending:
+                    # 負けた側は先に終わっていた（失敗・打ち切り）。払った分だけ数える
+                    for other in futures:
+                        if other is not future:
+                            self._count_loser(model, other, result)
+                return result
+        raise error
+
+    def _count_loser(self, model: str, future, winner: ChatResult) -> None:
+        # 使わなかった方の課金分。打ち切った場合は同じプロンプトを送った分だけ数える
+        try:
+            loser = future.result()
+            prompt, completion = loser.prompt_tokens or 0, loser.completion_tokens or 0
+        except Exception:
+            prompt, completion = winner.prompt_tokens or 0, 0
+        with self.lock:
+            extra = self.extra_tokens.setdefault(model, [0, 0])
+            extra[0] += prompt
+            extra[1] += completion
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            extra = {model: list(tokens) for model, tokens in self.extra_tokens.items()}
+            snapshot = {"requests": self.requests, "hedged": self.hedged, "hedge_wins": self.hedge_wins}
+        cost = 0.0
+        for model, (prompt, completion) in extra.items():
+            price = model_price(model)
+            if price is not None:
+                cost += (prompt * price[0] + completion * price[1]) / 1_000_000
+        snapshot["extra_prompt_tokens"] = sum(tokens[0] for tokens in extra.values())
+        snapshot["extra_completion_tokens"] = sum(tokens[1] for tokens in extra.values())
+        snapshot["extra_cost"] = cost
+        return snapshot
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Optional
+
+# ── 定数 ──
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+EVICT_BATCH = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    model TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    temperature REAL NOT NULL,
+    max_tokens INTEGER NOT NULL,
+    content TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (model, prompt_hash, temperature, max_tokens)
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+def prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode()).hexdigest()
+
+
+# ── LLM 応答のディスクキャッシュ（SQLite・最終利用時刻による LRU） ──
+class ResponseCache:
+    # キーは「モデル・レンダリング済みプロンプトのハッシュ・temperature・max_tokens」（引くときは max_tokens 以上）。
+    # 合計サイズが max_bytes を超えたら最後に使われた時刻が古いものから消す
+    def __init__(self, path: str, max_bytes: int = DEFAULT_MAX_BYTES, clock: Callable[[], float] = time.time):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, model: str, prompt: str, temperature: float, max_tokens: int) -> Optional[str]:
+        # max_tokens 以上の枠で保存された応答も使う（保存するのは途切れずに返った応答だけなので、
+        # 途切れて枠を倍にして取り直した応答を、次回は最初の枠のまま引ける）
+        key = (model, prompt_hash(prompt), temperature)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT max_tokens, content FROM responses"
+                " WHERE model = ? AND prompt_hash = ? AND temperature = ? AND max_tokens >= ?"
+                " ORDER BY max_tokens LIMIT 1",
+                (*key, max_tokens),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute(
+                "UPDATE responses SET last_used = ? WHERE model = ? AND prompt_hash = ? AND temperature = ? AND max_tokens = ?",
+                (self.clock(), *key, row[0]),
+            )
+            self.conn.commit()
+            self.hits += 1
+            return row[1]
+
+    def put(self, model: str, prompt: str, temperature: float, max_tokens: int, content: str) -> None:
+        key = (model, prompt_hash(prompt), temperature, max_tokens)
+        size = len(content.encode())
+        with self.lock:
+            old = self.conn.execute(
+                "SELECT size FROM responses WHERE model = ? AND prompt_hash = ? AND temperature = ? AND max_tokens = ?",
+                key,
+            ).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (*key, content, size, self.clock()),
+            )
+            self.total_bytes += size - (old[0] if old else 0)
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self) -> None:
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute(
+                "SELECT rowid, size FROM responses ORDER BY last_used LIMIT ?", (EVICT_BATCH,)
+            ).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                return
+            for rowid, size in rows:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM responses WHERE rowid = ?", (rowid,))
+                self.total_bytes -= size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": self.total_bytes,
+            }
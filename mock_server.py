@@ -0,0 +1,314 @@
+# ローカル検証用の OpenAI 互換スタブサーバ（標準ライブラリのみ）
+#   起動: python mock_server.py [--port 8765] [--latency 1.5] [--error-rate 0.05] [--truncate-rate 0.1] [--seed 0]
+#   /v1/chat/completions（ストリーミング含む）と Batch API（/v1/files・/v1/batches）に対応し、
+#   スキーマどおりのテロップを返す。遅延・エラー・途切れの出方は --seed で固定できる
+import argparse
+import email.parser
+import email.policy
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+HMS_IN_TEXT_RE = re.compile(r'(?<![\d:])(\d{2}:\d{2}:\d{2})(?![:;\d])')
+PACK_SECTION_RE = re.compile(r'\[チャンク (\d+)\]\n(.*?)(?=\n\[チャンク |\Z)', re.S)
+
+
+# ── 応答の生成 ──
+def fake_captions(prompt: str) -> list[dict]:
+    # 原稿中のタイムコードを拾い、positive と point を交互に並べる
+    times = HMS_IN_TEXT_RE.findall(prompt) or ["00:00:00"]
+    caps = []
+    for i, start in enumerate(times[:4]):
+        end = times[i + 1] if i + 1 < len(times) else start
+        if i % 2 == 0:
+            caps.append({"start": start, "end": end, "caption": "ここがポイント", "category": "positive"})
+        else:
+            caps.append({"start": start, "end": end, "caption": "糖質を抑えると体重が減りやすくなります", "category": "point"})
+    return caps
+
+
+def fake_side_caption(prompt: str) -> dict:
+    start = (HMS_IN_TEXT_RE.findall(prompt) or ["00:00:00"])[0]
+    return {"start": f"{start}:00", "caption": "痩せるならソバ！ 麺類糖質ランキング"}
+
+
+def fake_content(body: dict) -> str:
+    # プロンプトの種類（通常・束ね・まとめ生成・サイドテロップ）に合わせた形で返す
+    prompt = body["messages"][-1]["content"]
+    response_format = body.get("response_format") or {}
+    if '"side_caption"' in prompt:
+        data = {"captions": fake_captions(prompt), "side_caption": fake_side_caption(prompt)}
+    elif "[チャンク " in prompt:
+        sections = PACK_SECTION_RE.findall(prompt)
+        data = {"chunks": [{"chunk_id": int(i), "captions": fake_captions(text)} for i, text in sections]}
+    elif "見出しテロップ" in prompt:
+        data = fake_side_caption(prompt)
+    elif response_format:
+        data = {"captions": fake_captions(prompt)}
+    else:
+        data = fake_captions(prompt)
+    content = json.dumps(data, ensure_ascii=False)
+    return content if response_format else "```json\n" + content + "\n```"
+
+
+def fake_usage(body: dict, content: str) -> dict:
+    # トークン数は文字数の半分で近似する
+    prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 2
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 2,
+            "total_tokens": prompt_tokens + len(content) // 2}
+
+
+def fake_completion(body: dict, truncate: bool = False) -> dict:
+    # max_tokens に収まらない応答と truncate 指定の応答は途中で切って finish_reason="length" にする
+    content = fake_content(body)
+    limit = body.get("max_tokens") or len(content)
+    finish_reason = "stop"
+    if truncate or len(content) // 2 > limit:
+        content = content[:min(len(content) // 2, limit * 2)]
+        finish_reason = "length"
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+        "usage": fake_usage(body, content),
+    }
+
+
+def completion_chunks(completion: dict, include_usage: bool, size: int = 8) -> list[dict]:
+    # ストリーミング用に数文字ずつの chat.completion.chunk に分ける
+    content = completion["choices"][0]["message"]["content"]
+    base = {"id": completion["id"], "object": "chat.completion.chunk",
+            "created": completion["created"], "model": completion["model"]}
+    chunks = [dict(base, choices=[{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])]
+    for i in range(0, len(content), size):
+        chunks.append(dict(base, choices=[{"index": 0, "delta": {"content": content[i:i + size]}, "finish_reason": None}]))
+    chunks.append(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": completion["choices"][0]["finish_reason"]}]))
+    if include_usage:
+        chunks.append(dict(base, choices=[], usage=completion["usage"]))
+    return chunks
+
+
+# ── サーバの状態（応答の出方の設定と Batch API のファイル・バッチ） ──
+class MockState:
+    # latency は応答までの秒数の中央値。latency_sigma で対数正規分布のばらつき（遅い裾）を付ける
+    def __init__(
+        self, batch_delay: float = 5.0, error_rate: float = 0.0, latency: float = 0.0, latency_sigma: float = 0.0,
+        truncate_rate: float = 0.0, error_status: int = 500, seed: Optional[int] = None,
+    ):
+        self.batch_delay = batch_delay
+        self.error_rate = error_rate
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.truncate_rate = truncate_rate
+        self.error_status = error_status
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.files: dict[str, dict] = {}
+        self.batches: dict[str, dict] = {}
+
+    def draw(self) -> tuple[float, bool, bool]:
+        # リクエストごとの (遅延秒, エラーにするか, 途切れさせるか)
+        with self.lock:
+            delay = self.latency * self.rng.lognormvariate(0, self.latency_sigma) if self.latency else 0.0
+            return delay, self.rng.random() < self.error_rate, self.rng.random() < self.truncate_rate
+
+    def add_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        meta = {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+        with self.lock:
+            self.files[file_id] = {"meta": meta, "content": content}
+        return meta
+
+    def create_batch(self, input_file_id: str, endpoint: str, completion_window: str) -> dict:
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        lines = self.files[input_file_id]["content"].decode().splitlines()
+        batch = {
+            "id": batch_id, "object": "batch", "endpoint": endpoint, "input_file_id": input_file_id,
+            "completion_window": completion_window, "status": "validating", "created_at": int(time.time()),
+            "output_file_id": None, "error_file_id": None,
+            "request_counts": {"total": len([l for l in lines if l.strip()]), "completed": 0, "failed": 0},
+        }
+        with self.lock:
+            self.batches[batch_id] = {"batch": batch, "started": time.monotonic()}
+        return batch
+
+    def retrieve_batch(self, batch_id: str) -> dict:
+        with self.lock:
+            entry = self.batches[batch_id]
+        batch = entry["batch"]
+        if batch["status"] != "completed":
+            if time.monotonic() - entry["started"] >= self.batch_delay:
+                self._complete(batch)
+            else:
+                batch["status"] = "in_progress"
+        return batch
+
+    def _complete(self, batch: dict) -> None:
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]]["content"].decode().splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            row = {"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": request["custom_id"], "error": None}
+            if self.draw()[1]:
+                row["response"] = {"status_code": 500, "request_id": uuid.uuid4().hex,
+                                   "body": {"error": {"message": "mock server error", "type": "server_error"}}}
+                errors.append(row)
+            else:
+                row["response"] = {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                   "body": fake_completion(request["body"])}
+                outputs.append(row)
+
+        def to_file(rows, name):
+            if not rows:
+                return None
+            content = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows).encode()
+            return self.add_file(content, name, "batch_output")["id"]
+
+        batch["output_file_id"] = to_file(outputs, f"{batch['id']}_output.jsonl")
+        batch["error_file_id"] = to_file(errors, f"{batch['id']}_error.jsonl")
+        batch["request_counts"].update(completed=len(outputs), failed=len(errors))
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+
+
+# ── HTTP ──
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, fmt, *args):
+            pass
+
+        def send_json(self, obj, status=200):
+            data = json.dumps(obj, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def send_error_json(self, status: int):
+            if status == 429:
+                self.send_response(status)
+                data = json.dumps({"error": {"message": "mock rate limit", "type": "rate_limit_exceeded"}}).encode()
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("Retry-After", "1")
+                self.end_headers()
+                self.wfile.write(data)
+            else:
+                self.send_json({"error": {"message": "mock server error", "type": "server_error"}}, status)
+
+        def chat_completion(self):
+            body = json.loads(self.read_body())
+            delay, error, truncate = state.draw()
+            if error:
+                time.sleep(delay)
+                self.send_error_json(state.error_status)
+                return
+            completion = fake_completion(body, truncate)
+            if not body.get("stream"):
+                time.sleep(delay)
+                self.send_json(completion)
+                return
+            # ストリーミングは遅延の3割で最初のチャンクを返し、残りを本文に振り分ける
+            include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+            chunks = completion_chunks(completion, include_usage)
+            time.sleep(delay * 0.3)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            try:
+                for chunk in chunks:
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                    self.wfile.flush()
+                    time.sleep(delay * 0.7 / len(chunks))
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+            except ConnectionError:
+                # クライアントが受信を打ち切った（ヘッジで負けた側など）
+                pass
+
+        def do_POST(self):
+            if self.path == "/v1/chat/completions":
+                self.chat_completion()
+            elif self.path == "/v1/files":
+                ctype = self.headers["Content-Type"]
+                message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                    f"Content-Type: {ctype}\r\n\r\n".encode() + self.read_body()
+                )
+                fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+                upload = fields["file"]
+                self.send_json(state.add_file(
+                    upload.get_payload(decode=True), upload.get_filename() or "input.jsonl",
+                    fields["purpose"].get_content().strip(),
+                ))
+            elif self.path == "/v1/batches":
+                body = json.loads(self.read_body())
+                if body["input_file_id"] not in state.files:
+                    self.send_json({"error": {"message": "file not found"}}, 404)
+                    return
+                self.send_json(state.create_batch(body["input_file_id"], body["endpoint"], body["completion_window"]))
+            else:
+                self.send_json({"error": {"message": f"unknown path {self.path}"}}, 404)
+
+        def do_GET(self):
+            parts = self.path.strip("/").split("/")
+            if parts[:2] == ["v1", "batches"] and len(parts) == 3 and parts[2] in state.batches:
+                self.send_json(state.retrieve_batch(parts[2]))
+            elif parts[:2] == ["v1", "files"] and len(parts) == 4 and parts[3] == "content" and parts[2] in state.files:
+                content = state.files[parts[2]]["content"]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            else:
+                self.send_json({"error": {"message": f"unknown path {self.path}"}}, 404)
+
+    return Handler
+
+
+def start_server(state: MockState, port: int = 0) -> ThreadingHTTPServer:
+    # 別スレッドで起動する（port=0 なら空いているポート。アプリやベンチマークから同じプロセス内で使う）
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def base_url(server: ThreadingHTTPServer) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI 互換のローカルスタブサーバ")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--batch-delay", type=float, default=5.0, help="バッチが完了するまでの秒数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="失敗させるリクエストの割合")
+    parser.add_argument("--error-status", type=int, default=500, help="失敗させるときのステータス（429 なら Retry-After 付き）")
+    parser.add_argument("--latency", type=float, default=0.0, help="応答までの秒数（中央値）")
+    parser.add_argument("--latency-sigma", type=float, default=0.0, help="遅延のばらつき（対数正規分布のσ）")
+    parser.add_argument("--truncate-rate", type=float, default=0.0, help="finish_reason=length で途切れさせる割合")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    state = MockState(args.batch_delay, args.error_rate, args.latency, args.latency_sigma,
+                      args.truncate_rate, args.error_status, args.seed)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(state))
+    print(f"mock server: {base_url(server)}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
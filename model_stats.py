@@ -0,0 +1,72 @@
+import threading
+from typing import Optional
+
+# ── モデル別の単価（USD / 100万トークン。入力・出力） ──
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.50, 1.50),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+}
+
+
+def model_price(model: str) -> Optional[tuple[float, float]]:
+    # 日付付きのスナップショット名（gpt-4o-mini-2024-07-18 など）は最長一致で引く
+    names = [name for name in MODEL_PRICES if model == name or model.startswith(name + "-")]
+    return MODEL_PRICES[max(names, key=len)] if names else None
+
+
+# ── モデル別の集計（カスケード実行の内訳表示用） ──
+class ModelStats:
+    # API 呼び出しごとのレイテンシ・トークン数と、チャンクごとの合否をモデル単位で数える。
+    # 送信スレッドから呼ばれるのでロックで守る
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models: dict[str, dict] = {}
+
+    def _row(self, model: str) -> dict:
+        return self.models.setdefault(model, {
+            "calls": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0, "chunks": 0, "accepted": 0,
+        })
+
+    def record_call(self, model: str, seconds: float, prompt_tokens: int, completion_tokens: int) -> None:
+        with self.lock:
+            row = self._row(model)
+            row["calls"] += 1
+            row["seconds"] += seconds
+            row["prompt_tokens"] += prompt_tokens
+            row["completion_tokens"] += completion_tokens
+
+    def record_chunk(self, model: str, accepted: bool) -> None:
+        with self.lock:
+            row = self._row(model)
+            row["chunks"] += 1
+            row["accepted"] += accepted
+
+    def cost(self, model: str) -> Optional[float]:
+        price = model_price(model)
+        if price is None:
+            return None
+        with self.lock:
+            row = self._row(model)
+            return (row["prompt_tokens"] * price[0] + row["completion_tokens"] * price[1]) / 1_000_000
+
+    def rows(self) -> list[dict]:
+        rows = []
+        for model in list(self.models):
+            cost = self.cost(model)
+            with self.lock:
+                row = dict(self.models[model])
+            rows.append({
+                "モデル": model,
+                "チャンク": row["chunks"],
+                "合格率": f"{row['accepted'] / row['chunks']:.0%}" if row["chunks"] else "-",
+                "API 呼び出し": row["calls"],
+                "平均レイテンシ（秒）": round(row["seconds"] / row["calls"], 2) if row["calls"] else None,
+                "入力トークン": row["prompt_tokens"],
+                "出力トークン": row["completion_tokens"],
+                "費用（USD）": round(cost, 4) if cost is not None else None,
+            })
+        return rows
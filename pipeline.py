@@ -0,0 +1,187 @@
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator, Optional
+
+from captions import CombinedCaptions
+from transcript import ChunkPack, ChunkSpan, pack_texts, span_text
+
+
+# ── チャンク単位の処理結果 ──
+@dataclass
+class ChunkResult:
+    index: int
+    span: ChunkSpan
+    prompt: str
+    raw: Optional[str] = None
+    captions: Optional[list[dict]] = None
+    error: Optional[Exception] = None
+    attempts: int = 0
+    # ストリーミング中に届いたテロップ（送信スレッドが追記し、画面側が途中経過として読む）
+    partial: list[dict] = field(default_factory=list)
+    # フィルタで落ちたテロップ（違反ルール付き。まとめて修正依頼に回す）
+    rejected: list[dict] = field(default_factory=list)
+    # まとめ生成で一緒に返ってきた章の見出し（サイドテロップ）
+    side: list[dict] = field(default_factory=list)
+
+
+class ChunkParseError(Exception):
+    # 応答本文を残しておき、失敗時に画面へ出せるようにする
+    def __init__(self, raw: str, cause: Exception):
+        super().__init__(str(cause))
+        self.raw = raw
+        self.cause = cause
+
+
+class OutputTruncated(Exception):
+    # finish_reason == "length"（max_tokens に達して出力が途中で切れた）
+    def __init__(self, raw: str, max_tokens: int):
+        super().__init__(f"出力が max_tokens={max_tokens} で途切れました")
+        self.raw = raw
+        self.max_tokens = max_tokens
+
+
+# ── リトライ方針（指数バックオフ＋フルジッター） ──
+@dataclass
+class RetryPolicy:
+    attempts: int = 1
+    base_delay: float = 1.0
+    max_delay: float = 20.0
+    retryable: Callable[[Exception], bool] = lambda e: True
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def process_chunk(
+    job: ChunkResult,
+    send: Callable[[str, Callable[[dict], None]], str],
+    parse: Callable[[str], list[dict]],
+    retry: RetryPolicy,
+    sleep: Callable[[float], None] = time.sleep,
+) -> list[dict]:
+    # 送信とパースをひとまとめにしてリトライする（壊れた JSON も再送で直ることが多い）
+    for attempt in range(1, retry.attempts + 1):
+        job.attempts = attempt
+        partial = job.partial = []
+        try:
+            job.raw = send(job.prompt, partial.append)
+            try:
+                captions = parse(job.raw)
+                if isinstance(job.span, ChunkPack):
+                    captions = unpack_captions(job.span, captions)
+                if isinstance(captions, CombinedCaptions):
+                    captions, job.side = captions
+                return captions
+            except Exception as e:
+                raise ChunkParseError(job.raw, e) from e
+        except Exception as e:
+            if attempt >= retry.attempts or not retry.retryable(e):
+                raise
+            sleep(retry.backoff(attempt - 1))
+
+
+def unpack_captions(pack: ChunkPack, packed: dict[int, list[dict]]) -> list[dict]:
+    # チャンク番号ごとの応答を束の中の順に並べる。返ってこなかったチャンクがあれば失敗扱い
+    ids = range(pack.first, pack.first + len(pack.parts))
+    missing = [i for i in ids if i not in packed]
+    if missing:
+        raise ValueError(f"チャンク {missing} の結果がありません")
+    return [cap for i in ids for cap in packed[i]]
+
+
+# ── パイプライン各段（すべてジェネレータで、前段から1件ずつ受け取って流す） ──
+def iter_jobs(
+    text: str,
+    spans: Iterable[ChunkSpan],
+    build_prompt: Callable[[str], str],
+    indices: Optional[Iterable[int]] = None,
+) -> Iterator[ChunkResult]:
+    # indices を渡すと元のチャンク番号のまま流す（失敗チャンクの再実行用）。
+    # 束（ChunkPack）は [(チャンク番号, 本文), ...] を build_prompt に渡す
+    numbered = enumerate(spans, start=1) if indices is None else zip(indices, spans)
+    for i, span in numbered:
+        body = pack_texts(text, span) if isinstance(span, ChunkPack) else span_text(text, span)
+        yield ChunkResult(i, span, build_prompt(body))
+
+
+def iter_dispatched(
+    jobs: Iterable[ChunkResult],
+    send: Callable[[str, Callable[[dict], None]], str],
+    parse: Callable[[str], list[dict]],
+    concurrency: int = 1,
+    retry: RetryPolicy = RetryPolicy(),
+    poll: Optional[Callable[[list[ChunkResult]], None]] = None,
+    poll_interval: float = 0.25,
+) -> Iterator[ChunkResult]:
+    # 最大 concurrency 件を同時に投げ、終わった順に返す（並べ直しは呼び出し側で行う）。
+    # 常に1件多く投入しておき、応答待ちの間に後続チャンクの分割・プロンプト組み立てを進める。
+    # poll を渡すと、待っている間 poll_interval ごとに送信中のチャンク一覧を渡して呼ぶ
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    pending = {}
+
+    def wait_some():
+        while True:
+            done, _ = wait(pending, timeout=poll_interval if poll else None, return_when=FIRST_COMPLETED)
+            if done:
+                return done
+            poll(list(pending.values()))
+
+    try:
+        for job in jobs:
+            pending[pool.submit(process_chunk, job, send, parse, retry)] = job
+            if len(pending) > concurrency:
+                for future in wait_some():
+                    yield _collect(pending.pop(future), future)
+        while pending:
+            for future in wait_some():
+                yield _collect(pending.pop(future), future)
+    finally:
+        # 途中で打ち切られた場合、未送信のリクエストは取り消す
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _collect(job: ChunkResult, future) -> ChunkResult:
+    try:
+        job.captions = future.result()
+    except Exception as e:
+        job.error = e
+    return job
+
+
+def iter_filtered(
+    results: Iterable[ChunkResult],
+    keep: Callable[[list[dict]], list[dict]],
+    reject: Optional[Callable[[list[dict]], list[dict]]] = None,
+) -> Iterator[ChunkResult]:
+    # フィルタで例外が出ても、そのチャンクだけ失敗扱いにして後続を止めない
+    for result in results:
+        if result.captions is not None:
+            try:
+                if reject is not None:
+                    result.rejected = reject(result.captions)
+                result.captions = keep(result.captions)
+            except Exception as e:
+                result.captions = None
+                result.error = ChunkParseError(result.raw, e)
+        yield result
+
+
+def run_pipeline(
+    text: str,
+    spans: Iterable[ChunkSpan],
+    build_prompt: Callable[[str], str],
+    send: Callable[[str, Callable[[dict], None]], str],
+    parse: Callable[[str], list[dict]],
+    keep: Callable[[list[dict]], list[dict]] = lambda caps: caps,
+    concurrency: int = 1,
+    retry: RetryPolicy = RetryPolicy(),
+    indices: Optional[Iterable[int]] = None,
+    poll: Optional[Callable[[list[ChunkResult]], None]] = None,
+    reject: Optional[Callable[[list[dict]], list[dict]]] = None,
+) -> Iterator[ChunkResult]:
+    # 結果は完了順に流れてくる。失敗したチャンクも error 付きで流れてくるので、
+    # 呼び出し側で止めずに次へ進める
+    jobs = iter_jobs(text, spans, build_prompt, indices)
+    return iter_filtered(iter_dispatched(jobs, send, parse, concurrency, retry, poll), keep, reject)
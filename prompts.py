@@ -0,0 +1,204 @@
+import json
+
+
+# ── テロップ生成プロンプト ──
+CAPTION_RULES = """カテゴリと文字数ルール：
+- positive/negative/neutral：17文字以内。
+- positive/negative/neutralのカテゴリーは、文章が中途半端な状態で終わる場合は、次の文章と合体させて１回で完結させてください。次の文章と合体できず、中途半端な文章になってしまう場合は、そのテロップは削除してください。つまり、中途半端な文章は生成しないでください
+- point（詳細説明・解説・回答的内容）：20文字以上40文字未満。
+- pointカテゴリは必ず説明文形式で、文末は「〜です」または「〜ます」で終えること。
+- テロップ内の句読点（。、）は半角スペースに置換してください（！や？はそのままOK）。
+- pointカテゴリは必ずpositive/negative/neutralと交互に出力し、連続してpointを出さないこと。
+
+カテゴリ定義：
+- positive：前向き、モチベーション、安心感。
+- negative：注意喚起、問題提起、リスク。
+- neutral：中立的で客観的な事実説明。
+- point：詳細説明、理由、特徴、回答的な内容。
+"""
+
+
+def build_caption_prompt(chunk: str) -> str:
+    return f"""
+以下は動画のセリフ文字起こし（タイムコード付き）の断片です。
+この内容を「視聴者に一番伝えたいポイントを要約したテロップ」にリライトしてください。
+30秒あたりに**2〜3つ以上**のテロップを作成してください。
+必ずpointカテゴリを1つ以上生成してください（pointカテゴリは詳細説明文です）。
+
+{CAPTION_RULES}
+出力形式は以下のJSONでお願いします：
+[
+  {{
+    "start":"HH:MM:SS",
+    "end":"HH:MM:SS",
+    "caption":"ここにテロップ",
+    "category":"positive"
+  }},
+  …
+]
+
+断片：
+{chunk}
+"""
+
+
+# ── 複数チャンクをまとめたテロップ生成プロンプト（指示文を1回だけ送る） ──
+def build_packed_caption_prompt(parts: list[tuple[int, str]]) -> str:
+    chunks = "\n".join(f"[チャンク {i}]\n{text.strip()}" for i, text in parts)
+    return f"""
+以下は動画のセリフ文字起こし（タイムコード付き）を、連続する断片（チャンク）に分けたものです。
+チャンクごとに、内容を「視聴者に一番伝えたいポイントを要約したテロップ」にリライトしてください。
+各チャンクで30秒あたりに**2〜3つ以上**のテロップを作成してください。
+各チャンクで必ずpointカテゴリを1つ以上生成してください（pointカテゴリは詳細説明文です）。
+テロップの時刻はそのチャンクの範囲内にし、テロップが無いチャンクも含めて全チャンクの結果を返してください。
+
+{CAPTION_RULES}
+出力形式は以下のJSONでお願いします（chunk_id は [チャンク 番号] の番号）：
+{{
+  "chunks": [
+    {{
+      "chunk_id": 1,
+      "captions": [
+        {{
+          "start":"HH:MM:SS",
+          "end":"HH:MM:SS",
+          "caption":"ここにテロップ",
+          "category":"positive"
+        }},
+        …
+      ]
+    }},
+    …
+  ]
+}}
+
+チャンク：
+{chunks}
+"""
+
+
+# ── サイドテロップ生成プロンプト ──
+SIDE_CAPTION_RULES = """句読点はすべて半角スペースに置き換え、
+必ず以下の体裁に統一してください。
+
+【テロップフォーマット】
+「キャッチコピー（末尾に！や？などの強調記号）　補足説明」
+（例）
+「痩せるならソバ！　麺類糖質ランキング」
+「糖質制限で痩せる？　簡単ダイエットの裏技」
+
+キャッチコピーの末尾には必ず「！」や「？」「！！」などの強調記号を付けてください。
+補足説明はキャッチコピーの後に半角スペースで区切り、わかりやすく短くまとめてください。
+文字数はキャッチコピー＋補足説明合わせて16文字以上20文字以内に収めてください。
+もし文字数が不足する場合は、キャッチーな一言や強調語を付け足して必ず16文字以上に調整してください。
+また、もし20文字を超える場合は、20文字以内に調整してください。
+"""
+
+
+def build_side_caption_prompt(chapter: str) -> str:
+    return f"""
+以下の文字起こし原稿（章）から、視聴者が続きを見たくなるような
+インパクトのある「見出しテロップ」を1つだけ作成してください。
+{SIDE_CAPTION_RULES}
+フォーマットは以下の通りです：
+{{
+"start":"HH:MM:SS:FF",
+"caption":"ここにテロップ"
+}}
+
+章：
+{chapter}
+"""
+
+
+# ── テロップとサイドテロップをまとめて生成するプロンプト（章ごとに1回） ──
+def build_combined_prompt(chapter: str) -> str:
+    return f"""
+以下は動画のセリフ文字起こし（タイムコード付き）の1章分です。
+次の2つを作成してください。
+
+1. テロップ（captions）
+この内容を「視聴者に一番伝えたいポイントを要約したテロップ」にリライトしてください。
+30秒あたりに**2〜3つ以上**のテロップを作成してください。
+必ずpointカテゴリを1つ以上生成してください（pointカテゴリは詳細説明文です）。
+
+{CAPTION_RULES}
+2. サイドテロップ（side_caption）
+この章から、視聴者が続きを見たくなるような
+インパクトのある「見出しテロップ」を1つだけ作成してください。
+{SIDE_CAPTION_RULES}
+出力形式は以下のJSONでお願いします：
+{{
+  "captions": [
+    {{
+      "start":"HH:MM:SS",
+      "end":"HH:MM:SS",
+      "caption":"ここにテロップ",
+      "category":"positive"
+    }},
+    …
+  ],
+  "side_caption": {{
+    "start":"HH:MM:SS:FF",
+    "caption":"ここにテロップ"
+  }}
+}}
+
+章：
+{chapter}
+"""
+
+
+# ── フィルタで落ちたテロップの修正依頼プロンプト ──
+def build_repair_prompt(rejected: list[dict]) -> str:
+    items = "\n".join(
+        json.dumps(
+            {"start": cap.get("start", ""), "end": cap.get("end", ""), "caption": cap.get("caption", ""),
+             "category": cap.get("category", ""), "直すルール": cap.get("violations", [])},
+            ensure_ascii=False,
+        )
+        for cap in rejected
+    )
+    return f"""
+以下は動画のテロップ案のうち、ルールを満たさなかったものです。
+それぞれ「直すルール」に従って書き換えてください。内容の意味は変えないでください。
+start と end はそのまま残し、1件につき1つのテロップを返してください。
+
+カテゴリと文字数ルール：
+- positive/negative/neutral：17文字以内。
+- point（詳細説明・解説・回答的内容）：15文字以上40文字未満の説明文で、文末は「〜です」または「〜ます」。
+- pointを連続させないこと。
+- テロップ内の句読点（。、）は半角スペースに置換してください（！や？はそのままOK）。
+
+出力形式は以下のJSONでお願いします：
+[
+  {{
+    "start":"HH:MM:SS",
+    "end":"HH:MM:SS",
+    "caption":"ここにテロップ",
+    "category":"positive"
+  }}
+]
+
+修正するテロップ：
+{items}
+"""
+
+
+# ── 構造化出力モードで添える指示（応答の外枠をスキーマに合わせる） ──
+STRUCTURED_CAPTION_INSTRUCTION = (
+    'テロップの配列は {"captions": [...]} の形の JSON オブジェクトに入れて返してください。'
+    "JSON 以外の文章やコードブロックは付けないでください。"
+)
+STRUCTURED_PACKED_CAPTION_INSTRUCTION = (
+    '結果は {"chunks": [{"chunk_id": 番号, "captions": [...]}]} の形の JSON オブジェクトで返してください。'
+    "JSON 以外の文章やコードブロックは付けないでください。"
+)
+STRUCTURED_COMBINED_INSTRUCTION = (
+    '結果は {"captions": [...], "side_caption": {"start": "...", "caption": "..."}} の JSON オブジェクトで返してください。'
+    "JSON 以外の文章やコードブロックは付けないでください。"
+)
+STRUCTURED_SIDE_CAPTION_INSTRUCTION = (
+    'サイドテロップは {"start": "...", "caption": "..."} の JSON オブジェクト1つで返してください。'
+    "JSON 以外の文章やコードブロックは付けないでください。"
+)
@@ -0,0 +1,104 @@
+import threading
+import time
+from typing import Callable, Mapping
+
+
+# ── トークンバケット ──
+class TokenBucket:
+    # 1分あたり limit 回（トークン）まで。満タンから始めて毎秒 limit/60 ずつ回復する
+    def __init__(self, limit: float, clock: Callable[[], float] = time.monotonic):
+        self.limit = float(limit)
+        self.level = float(limit)
+        self.clock = clock
+        self.updated = clock()
+
+    @property
+    def rate(self) -> float:
+        return self.limit / 60.0
+
+    def refill(self) -> None:
+        now = self.clock()
+        self.level = min(self.limit, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # limit を超える要求は満タンになった時点で通す
+        needed = min(amount, self.limit) - self.level
+        return 0.0 if needed <= 0 else needed / self.rate
+
+
+# ── RPM / TPM リミッタ ──
+class RateLimiter:
+    # 送信前に「プロンプトのトークン数＋max_tokens」を予約し、
+    # レスポンスの x-ratelimit-* ヘッダでサーバ側の残量に合わせる
+    def __init__(
+        self,
+        rpm: int,
+        tpm: int,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.requests = TokenBucket(rpm, clock)
+        self.tokens = TokenBucket(tpm, clock)
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.waited = 0.0
+
+    def wait_time(self, tokens: int) -> float:
+        # 今 acquire したら何秒待つことになるか（予約はしない）
+        with self.lock:
+            return self._wait_time(tokens)
+
+    def _wait_time(self, tokens: int) -> float:
+        self.requests.refill()
+        self.tokens.refill()
+        return max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    def acquire(self, tokens: int) -> float:
+        # 両方のバケットに空きができるまで待ち、待った秒数を返す
+        waited = 0.0
+        while True:
+            with self.lock:
+                delay = self._wait_time(tokens)
+                if delay <= 0:
+                    self.requests.level -= 1
+                    self.tokens.level -= tokens
+                    self.waited += waited
+                    return waited
+            delay = min(delay, 1.0)
+            self.sleep(delay)
+            waited += delay
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        with self.lock:
+            for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+                limit = _header_int(headers, f"x-ratelimit-limit-{kind}")
+                remaining = _header_int(headers, f"x-ratelimit-remaining-{kind}")
+                if limit is not None and limit > 0:
+                    bucket.limit = float(limit)
+                if remaining is not None:
+                    bucket.refill()
+                    # 手元の残量がサーバより多いときだけ下げる（送信中の予約分は手元にしか無い）
+                    bucket.level = min(bucket.level, float(remaining))
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            self.requests.refill()
+            self.tokens.refill()
+            return {
+                "rpm_limit": int(self.requests.limit),
+                "rpm_remaining": max(0, int(self.requests.level)),
+                "tpm_limit": int(self.tokens.limit),
+                "tpm_remaining": max(0, int(self.tokens.level)),
+                "waited_sec": round(self.waited, 1),
+            }
+
+
+def _header_int(headers: Mapping[str, str], name: str):
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
@@ -0,0 +1,46 @@
+import threading
+from concurrent.futures import Future
+from typing import Callable, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+# ── 同一リクエストの相乗り（single-flight） ──
+class SingleFlight:
+    # 同じキーの呼び出しが実行中なら、新たに投げずにその結果（または例外）を待って共有する。
+    # プロセス全体で1つだけ作り、複数セッションから使う
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight: dict[Hashable, Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = self.in_flight[key] = Future()
+                self.calls += 1
+                leader = True
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self.in_flight)}
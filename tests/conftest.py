@@ -0,0 +1,18 @@
+import pytest
+
+
+class FakeClock:
+    # sleep で時間が進む時計（待ち時間を実際には待たずに確かめる）
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,97 @@
+# オフライン（Batch API）モード
+import json
+from types import SimpleNamespace
+
+import batch
+from batch import (
+    collect_captions, iter_batch_requests, iter_batch_results, split_custom_id, wait_for_batches, write_batch_files,
+)
+
+POINT = "糖質を抑えると体重が減りやすくなります"
+
+
+def structured(*caps) -> str:
+    return json.dumps({"captions": list(caps)}, ensure_ascii=False)
+
+
+def cap(start: str, caption: str, category: str = "neutral") -> dict:
+    return {"start": start, "end": start, "caption": caption, "category": category}
+
+
+# ── 結果の振り分け ──
+def test_collect_captions_by_video_and_chunk():
+    results = [
+        ("講座#1#2", structured(cap("00:00:21", "次の話")), None),
+        ("講座#1#1", structured(cap("00:00:01", "はじめ"), cap("00:00:02", POINT, "point")), None),
+        ("別#1", None, '{"message": "server error"}'),
+    ]
+    videos = collect_captions(results, "json_object")
+    assert sorted(videos) == ["別", "講座#1"]
+    assert [c["caption"] for c in videos["講座#1"]["done"][1]] == ["はじめ", POINT]
+    assert videos["講座#1"]["failed"] == {}
+    assert videos["別"] == {"done": {}, "failed": {1: '{"message": "server error"}'}}
+
+
+def test_collect_captions_filters_and_reports_parse_failures():
+    results = [
+        ("v#1", structured(cap("00:00:01", "書き直しても十七文字の上限を超えてしまったテロップ"), cap("xx", "時刻なし")), None),
+        ("v#2", "[壊れた JSON", None),
+        ("v#3", structured({**cap("00:00:01", "x"), "category": "other"}), None),
+    ]
+    videos = collect_captions(results, "json_object")
+    assert videos["v"]["done"] == {1: []}
+    assert sorted(videos["v"]["failed"]) == [2, 3]
+    assert videos["v"]["failed"][2].startswith("パース失敗")
+
+
+def test_collect_captions_in_text_mode_strips_fences():
+    raw = "```json\n" + json.dumps([cap("00:00:01", "はじめ")], ensure_ascii=False) + "\n```"
+    assert collect_captions([("v#1", raw, None)], "text")["v"]["done"][1][0]["caption"] == "はじめ"
+
+
+# ── リクエストの組み立て ──
+def test_requests_are_numbered_per_video():
+    videos = {"a": "00:00:00\nx\n00:00:25\ny\n", "b": "00:00:00\nz\n"}
+    ids = [r["custom_id"] for r in iter_batch_requests(videos, "m", "json_schema")]
+    assert ids == ["a#1", "a#2", "b#1"]
+    assert split_custom_id("講座#1#2") == ("講座#1", 2)
+
+
+def test_batch_files_are_split_at_the_request_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "BATCH_MAX_REQUESTS", 2)
+    paths = write_batch_files(({"custom_id": f"v#{i}"} for i in range(1, 6)), tmp_path)
+    assert [len(p.read_text(encoding="utf-8").splitlines()) for p in paths] == [2, 2, 1]
+
+
+# ── Batch API ──
+class FakeClient:
+    def __init__(self, statuses: dict[str, list[str]], files: dict[str, str] = None):
+        self.statuses = statuses
+        self.batches = SimpleNamespace(retrieve=self.retrieve)
+        self.files = SimpleNamespace(content=lambda file_id: SimpleNamespace(text=(files or {})[file_id]))
+
+    def retrieve(self, batch_id):
+        statuses = self.statuses[batch_id]
+        status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        return SimpleNamespace(id=batch_id, status=status)
+
+
+def test_wait_for_batches_polls_until_all_finish():
+    client = FakeClient({"b1": ["in_progress", "completed"], "b2": ["validating", "in_progress", "failed"]})
+    sleeps = []
+    done = wait_for_batches(client, ["b1", "b2"], 30, sleeps.append)
+    assert [b.status for b in done] == ["completed", "failed"]
+    assert sleeps == [30, 30]
+
+
+def test_batch_results_include_error_rows():
+    ok = {"custom_id": "v#1", "response": {"status_code": 200, "body": {"choices": [{"message": {"content": "[]"}}]}}}
+    http_error = {"custom_id": "v#2", "response": {"status_code": 429, "body": {"error": {"message": "rate"}}}}
+    expired = {"custom_id": "v#3", "response": None, "error": {"code": "batch_expired"}}
+    client = FakeClient({}, {"out": json.dumps(ok) + "\n\n", "err": json.dumps(http_error) + "\n" + json.dumps(expired)})
+    rows = list(iter_batch_results(client, SimpleNamespace(output_file_id="out", error_file_id="err")))
+    assert rows == [
+        ("v#1", "[]", None),
+        ("v#2", None, '{"message": "rate"}'),
+        ("v#3", None, '{"code": "batch_expired"}'),
+    ]
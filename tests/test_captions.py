@@ -0,0 +1,137 @@
+# 応答のパースとフィルタ
+import json
+
+import pytest
+
+from captions import (
+    CAPTION_SCHEMA, JsonObjectStream, insert_repaired, parse_captions, parse_combined_captions, parse_structured_captions,
+    parse_structured_side_caption, response_format_for,
+)
+
+
+# ── 応答のパース ──
+def test_text_mode_rejects_wrong_shapes():
+    with pytest.raises(ValueError):
+        parse_captions('{"captions": [{"start": "00:00:01", "caption": "x"}]}')
+    with pytest.raises(ValueError):
+        parse_captions('[{"start": "00:00:01", "caption": "x", "category": null}]')
+    with pytest.raises(ValueError):
+        parse_captions('["00:00:01"]')
+    # end・category の欠けはフィルタ側で扱う
+    assert parse_captions('```json\n[{"start": "00:00:01", "caption": "x"}]\n```') == [
+        {"start": "00:00:01", "caption": "x"},
+    ]
+
+
+# ── 構造化出力 ──
+CAP = {"start": "00:00:01", "end": "00:00:03", "caption": "字幕", "category": "point"}
+
+
+def test_structured_mode_parses_the_wrapper():
+    assert parse_structured_captions(json.dumps({"captions": [CAP]})) == [CAP]
+
+
+@pytest.mark.parametrize("data", [
+    [CAP],
+    {"captions": [{**CAP, "category": "other"}]},
+    {"captions": [{k: v for k, v in CAP.items() if k != "end"}]},
+    {"items": [CAP]},
+])
+def test_structured_mode_rejects_off_schema_replies(data):
+    with pytest.raises(ValueError):
+        parse_structured_captions(json.dumps(data))
+
+
+def test_structured_side_caption():
+    assert parse_structured_side_caption('{"caption": "見出し。です、"}') == [{"caption": "見出し です "}]
+    with pytest.raises(ValueError):
+        parse_structured_side_caption('{"text": "見出し"}')
+
+
+def test_combined_reply_carries_captions_and_side_caption():
+    combined = parse_combined_captions(json.dumps({"captions": [CAP], "side_caption": {"caption": "章。見出し"}}))
+    assert (combined.captions, combined.side) == ([CAP], [{"caption": "章 見出し"}])
+    with pytest.raises(ValueError):
+        parse_combined_captions(json.dumps({"captions": [CAP]}))
+    with pytest.raises(ValueError):
+        parse_combined_captions(json.dumps([CAP]))
+
+
+def test_response_format_for_each_mode():
+    assert response_format_for("json_schema", CAPTION_SCHEMA) == {"type": "json_schema", "json_schema": CAPTION_SCHEMA}
+    assert response_format_for("json_object", CAPTION_SCHEMA) == {"type": "json_object"}
+    assert response_format_for("text", CAPTION_SCHEMA) is None
+
+
+# ── ストリーミング応答の逐次パース ──
+def feed_all(stream: JsonObjectStream, text: str, size: int) -> list[dict]:
+    items = []
+    for i in range(0, len(text), size):
+        items += stream.feed(text[i:i + size])
+    return items
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 1000])
+def test_stream_ignores_braces_and_escapes_inside_strings(size):
+    raw = (
+        '```json\n['
+        '{"start": "00:00:01", "caption": "波括弧 { と } を含む", "category": "point"},'
+        '{"start": "00:00:02", "caption": "引用 \\"}\\" と \\\\ を含む", "category": "neutral"}'
+        ']\n```'
+    )
+    items = feed_all(JsonObjectStream(), raw, size)
+    assert [item["caption"] for item in items] == ["波括弧 { と } を含む", '引用 "}" と \\ を含む']
+
+
+@pytest.mark.parametrize("size", [1, 5, 1000])
+def test_stream_level_skips_wrapper_objects(size):
+    raw = '{"captions": [{"start": "00:00:01", "meta": {"x": 1}}, {"start": "00:00:02"}]}'
+    items = feed_all(JsonObjectStream(level=1), raw, size)
+    assert items == [{"start": "00:00:01", "meta": {"x": 1}}, {"start": "00:00:02"}]
+
+
+def test_stream_skips_prose_and_broken_objects():
+    stream = JsonObjectStream()
+    assert stream.feed('以下です "引用" {"start": "00:00:01"} {"start": ') == [{"start": "00:00:01"}]
+    assert stream.feed('"00:00:02",} {"start": "00:00:03"}') == [{"start": "00:00:03"}]
+
+
+def test_stream_yields_each_object_once_across_feeds():
+    stream = JsonObjectStream()
+    assert stream.feed('[{"a": 1}, {"b": "}') == [{"a": 1}]
+    assert stream.feed('"}') == [{"b": "}"}]
+    assert stream.feed("]") == []
+
+
+# ── 書き直したテロップの差し込み ──
+POINT = "糖質を抑えると体重が減りやすくなります"
+
+
+def cap(start: str, caption: str, category: str = "neutral") -> dict:
+    return {"start": start, "end": start, "caption": caption, "category": category}
+
+
+def test_repaired_captions_go_into_their_chunk_in_time_order():
+    done = {1: [cap("00:00:01", "はじめ"), cap("00:00:09", "おわり")], 2: [cap("00:00:21", "次の話")]}
+    repaired = [cap("00:00:25", "補足"), cap("00:00:05", "なかほど")]
+    assert insert_repaired(done, [0, 20000], repaired) == 2
+    assert [c["caption"] for c in done[1]] == ["はじめ", "なかほど", "おわり"]
+    assert [c["caption"] for c in done[2]] == ["次の話", "補足"]
+
+
+def test_repaired_captions_never_displace_accepted_ones():
+    # 直前が point の位置に point を差し込むと直前か自身が落ちるので、書き直しの方を捨てる
+    accepted = [cap("00:00:01", POINT, "point"), cap("00:00:09", "おわり")]
+    done = {1: [dict(c) for c in accepted]}
+    repaired = [
+        cap("00:00:05", "体重が減りやすくなる理由を説明します", "point"),
+        cap("00:00:06", "書き直しても十七文字の上限を超えてしまったテロップ"),
+    ]
+    assert insert_repaired(done, [0], repaired) == 0
+    assert done[1] == accepted
+
+
+def test_repaired_captions_for_failed_chunks_are_skipped():
+    done = {2: [cap("00:00:21", "次の話")]}
+    assert insert_repaired(done, [0, 20000], [cap("00:00:05", "なかほど")]) == 0
+    assert done == {2: [cap("00:00:21", "次の話")]}
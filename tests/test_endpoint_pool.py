@@ -0,0 +1,147 @@
+# 複数の接続先への振り分けと切り替え
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+from backends import Cancelled, ChatResult
+from endpoint_pool import COOLDOWN_BASE, Endpoint, EndpointPool, make_pool
+from ratelimit import RateLimiter
+
+
+def status_error(status: int, retry_after=None) -> openai.APIStatusError:
+    headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+    response = SimpleNamespace(request=None, status_code=status, headers=headers)
+    return openai.APIStatusError(f"{status}", response=response, body=None)
+
+
+class FakeBackend:
+    # replies を順に返す（例外なら投げる）。尽きたら正常な応答
+    label = "fake"
+
+    def __init__(self, *replies, deltas=()):
+        self.replies = list(replies)
+        self.deltas = deltas
+        self.calls = 0
+
+    def complete(self, model, messages, max_tokens, temperature, response_format=None, on_delta=None):
+        self.calls += 1
+        for delta in self.deltas:
+            if on_delta is not None:
+                on_delta(delta)
+        reply = self.replies.pop(0) if self.replies else "ok"
+        if isinstance(reply, Exception):
+            raise reply
+        return ChatResult(reply, "stop", 10, 5, {})
+
+
+def make(clock, *backends, **kwargs):
+    endpoints = [Endpoint(f"e{i}", backend) for i, backend in enumerate(backends, start=1)]
+    return EndpointPool(endpoints, clock=clock, **kwargs)
+
+
+def call(pool, on_delta=None):
+    return pool.complete("m", [], 100, 0.0, on_delta=on_delta, tokens=200)
+
+
+# ── 切り替え ──
+@pytest.mark.parametrize("error", [status_error(500), status_error(429), openai.APIConnectionError(request=None)])
+def test_fails_over_to_the_next_endpoint(clock, error):
+    first, second = FakeBackend(error), FakeBackend("from e2")
+    pool = make(clock, first, second)
+    assert call(pool).content == "from e2"
+    assert pool.failovers == 1
+    assert (first.calls, second.calls) == (1, 1)
+    assert pool.endpoints[0].failures == 1 and pool.endpoints[0].outstanding_tokens == 0
+
+
+def test_client_errors_are_not_failed_over(clock):
+    second = FakeBackend()
+    pool = make(clock, FakeBackend(status_error(400)), second)
+    with pytest.raises(openai.APIStatusError):
+        call(pool)
+    assert second.calls == 0 and pool.failovers == 0
+
+
+def test_no_failover_after_deltas_were_emitted(clock):
+    # 途中まで表示した応答を別の接続先でやり直すと二重になる
+    second = FakeBackend()
+    pool = make(clock, FakeBackend(status_error(500), deltas=["[{"]), second)
+    with pytest.raises(openai.APIStatusError):
+        call(pool, on_delta=lambda delta: None)
+    assert second.calls == 0
+
+
+def test_raises_the_last_error_when_every_endpoint_fails(clock):
+    pool = make(clock, FakeBackend(status_error(500)), FakeBackend(status_error(503)))
+    with pytest.raises(openai.APIStatusError) as info:
+        call(pool)
+    assert info.value.status_code == 503
+
+
+# ── 休止 ──
+def test_failed_endpoint_cools_down_and_is_tried_last(clock):
+    first, second = FakeBackend(status_error(500)), FakeBackend()
+    pool = make(clock, first, second)
+    call(pool)
+    assert pool.endpoints[0].cooldown_until == COOLDOWN_BASE
+    call(pool)
+    call(pool)
+    assert (first.calls, second.calls) == (1, 3)
+    clock.sleep(COOLDOWN_BASE)
+    call(pool)
+    assert first.calls == 2
+
+
+def test_cooldown_doubles_with_consecutive_failures(clock):
+    pool = make(clock, FakeBackend(status_error(500), status_error(500)))
+    for _ in range(2):
+        with pytest.raises(openai.APIStatusError):
+            call(pool)
+    assert pool.endpoints[0].cooldown_until == pytest.approx(2 * COOLDOWN_BASE)
+
+
+def test_cooldown_follows_retry_after(clock):
+    pool = make(clock, FakeBackend(status_error(429, retry_after=7)), FakeBackend())
+    call(pool)
+    assert pool.endpoints[0].cooldown_until == 7.0
+
+
+def test_cancelled_calls_are_not_failures(clock):
+    pool = make(clock, FakeBackend(Cancelled()), FakeBackend())
+    with pytest.raises(Cancelled):
+        call(pool)
+    assert pool.endpoints[0].failures == 0 and pool.endpoints[0].cooldown_until == 0
+
+
+# ── 振り分け ──
+def test_prefers_an_endpoint_the_rate_limiter_admits_now(clock):
+    busy = RateLimiter(rpm=1, tpm=100000, clock=clock, sleep=clock.sleep)
+    busy.acquire(1)
+    endpoints = [Endpoint("busy", FakeBackend(), limiter=busy), Endpoint("free", FakeBackend())]
+    pool = EndpointPool(endpoints, clock=clock)
+    assert pool.reserve(200, []).name == "free"
+
+
+def test_spreads_load_by_weight(clock):
+    endpoints = [Endpoint("heavy", FakeBackend(), weight=3), Endpoint("light", FakeBackend())]
+    pool = EndpointPool(endpoints, clock=clock)
+    picks = [pool.reserve(100, []).name for _ in range(4)]
+    assert picks.count("heavy") == 3
+
+
+# ── 設定 ──
+def fake_backend(kind, api_key, base_url, mock, max_retries):
+    return FakeBackend()
+
+
+def test_make_pool_limits_openai_entries_by_default():
+    pool = make_pool([{"name": "a"}, {"kind": "compatible", "base_url": "http://x"}], fake_backend, (60, 1000))
+    assert pool.endpoints[0].limiter is not None and pool.endpoints[1].limiter is None
+    assert pool.endpoints[1].name == "compatible-2"
+
+
+@pytest.mark.parametrize("weight", [0, -1, "nan"])
+def test_make_pool_rejects_non_positive_weights(weight):
+    with pytest.raises(ValueError, match="weight は正の数"):
+        make_pool([{"name": "a", "weight": weight}], fake_backend, (60, 1000))
@@ -0,0 +1,149 @@
+# 遅いリクエストのヘッジ（複製送信）
+import threading
+import time
+
+import pytest
+
+from backends import Cancelled, ChatResult
+from hedging import Hedger
+
+TIMEOUT = 5
+MODEL = "gpt-4o-mini"
+
+
+class Attempts:
+    # 呼ばれた順に behaviours[i](on_delta) を実行する（0 番目が元のリクエスト、1 番目が複製）
+    def __init__(self, *behaviours):
+        self.behaviours = behaviours
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def __call__(self, model, messages, max_tokens, temperature, response_format, on_delta, tokens):
+        with self.lock:
+            behaviour = self.behaviours[self.calls]
+            self.calls += 1
+        return behaviour(on_delta)
+
+
+def result(content: str, completion_tokens: int = 5) -> ChatResult:
+    return ChatResult(content, "stop", 10, completion_tokens, {})
+
+
+def seeded(complete, latency: float = 0.05, samples: int = 10, streaming: bool = False, **kwargs) -> Hedger:
+    hedger = Hedger(complete, **kwargs)
+    for _ in range(samples):
+        hedger._record_latency(MODEL, streaming, latency)
+    return hedger
+
+
+def call(hedger, on_delta=None) -> ChatResult:
+    return hedger.complete(MODEL, [], 100, 0.0, on_delta=on_delta)
+
+
+def finish(hedger) -> dict:
+    # 負けた側の課金分は、その呼び出しが終わってから数えられる
+    hedger.pool.shutdown(wait=True)
+    return hedger.snapshot()
+
+
+def slow(release: threading.Event, reply: ChatResult):
+    def behaviour(on_delta):
+        assert release.wait(TIMEOUT)
+        return reply
+    return behaviour
+
+
+# ── ヘッジするかどうか ──
+def test_no_hedge_until_enough_latencies_are_recorded():
+    complete = Attempts(lambda on_delta: (time.sleep(0.1), result("only"))[1])
+    hedger = seeded(complete, samples=9, budget=1.0)
+    assert call(hedger).content == "only"
+    assert complete.calls == 1 and hedger.hedged == 0
+
+
+def test_fast_replies_are_not_hedged():
+    complete = Attempts(lambda on_delta: result("fast"))
+    hedger = seeded(complete, latency=1.0, budget=1.0)
+    assert call(hedger).content == "fast"
+    assert complete.calls == 1
+
+
+def test_hedges_stay_within_the_budget():
+    # 記録済みの p90 が 5ms なので毎回ヘッジしたくなるが、複製は全体の 10% まで
+    def behaviour(on_delta):
+        time.sleep(0.02)
+        return result("slow")
+
+    hedger = seeded(Attempts(*[behaviour] * 40), latency=0.005, samples=1000, window=1000, budget=0.1)
+    for _ in range(20):
+        call(hedger)
+    assert (hedger.requests, hedger.hedged) == (20, 2)
+
+
+# ── 先着 ──
+def test_hedge_wins_when_the_primary_is_slow():
+    release = threading.Event()
+    hedger = seeded(Attempts(slow(release, result("primary", 50)), lambda on_delta: result("hedge")), budget=1.0)
+    assert call(hedger).content == "hedge"
+    release.set()
+    snapshot = finish(hedger)
+    assert (snapshot["hedged"], snapshot["hedge_wins"]) == (1, 1)
+    # 負けた元のリクエストも最後まで返ったので、その分を丸ごと数える
+    assert (snapshot["extra_prompt_tokens"], snapshot["extra_completion_tokens"]) == (10, 50)
+
+
+def test_streaming_loser_is_cancelled_at_its_first_delta():
+    release = threading.Event()
+    cancelled = threading.Event()
+
+    def primary(on_delta):
+        assert release.wait(TIMEOUT)
+        try:
+            on_delta("primary")
+        except Cancelled:
+            cancelled.set()
+            raise
+        return result("primary")
+
+    def hedge(on_delta):
+        on_delta("hedge")
+        return result("hedge")
+
+    deltas = []
+    hedger = seeded(Attempts(primary, hedge), streaming=True, budget=1.0)
+    assert call(hedger, on_delta=deltas.append).content == "hedge"
+    release.set()
+    assert cancelled.wait(TIMEOUT)
+    snapshot = finish(hedger)
+    assert deltas == ["hedge"]
+    # 打ち切った側はプロンプトを送った分だけ
+    assert (snapshot["extra_prompt_tokens"], snapshot["extra_completion_tokens"]) == (10, 0)
+
+
+# ── 失敗 ──
+def test_a_failed_hedge_falls_back_to_the_primary():
+    release = threading.Event()
+
+    def hedge(on_delta):
+        release.set()
+        raise ConnectionError("down")
+
+    hedger = seeded(Attempts(slow(release, result("primary")), hedge), budget=1.0)
+    assert call(hedger).content == "primary"
+    assert finish(hedger)["hedge_wins"] == 0
+
+
+def test_raises_the_real_error_when_both_attempts_fail():
+    release = threading.Event()
+
+    def primary(on_delta):
+        assert release.wait(TIMEOUT)
+        raise TimeoutError("primary")
+
+    def hedge(on_delta):
+        release.set()
+        raise ConnectionError("hedge")
+
+    hedger = seeded(Attempts(primary, hedge), budget=1.0)
+    with pytest.raises((TimeoutError, ConnectionError)):
+        call(hedger)
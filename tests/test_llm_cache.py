@@ -0,0 +1,69 @@
+# LLM 応答のディスクキャッシュ
+import itertools
+
+from llm_cache import ResponseCache
+
+
+def test_evicts_least_recently_used(tmp_path):
+    ticks = itertools.count()
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), max_bytes=20, clock=lambda: next(ticks))
+    cache.put("m", "a", 0.8, 100, "x" * 8)
+    cache.put("m", "b", 0.8, 100, "y" * 8)
+    assert cache.get("m", "a", 0.8, 100) == "x" * 8  # a を最近使ったことにする
+    cache.put("m", "c", 0.8, 100, "z" * 8)
+    assert cache.get("m", "b", 0.8, 100) is None
+    assert cache.get("m", "a", 0.8, 100) == "x" * 8
+    stats = cache.stats()
+    assert (stats["entries"], stats["bytes"], stats["evictions"]) == (2, 16, 1)
+
+
+def test_replacing_an_entry_counts_its_size_once(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"))
+    cache.put("m", "p", 0.8, 100, "あ" * 4)
+    cache.put("m", "p", 0.8, 100, "い" * 2)
+    assert cache.stats()["bytes"] == 6
+    assert cache.get("m", "p", 0.8, 100) == "いい"
+
+
+def test_key_includes_model_and_temperature(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"))
+    cache.put("m", "p", 0.8, 100, "short")
+    assert cache.get("other", "p", 0.8, 100) is None
+    assert cache.get("m", "p", 0.2, 100) is None
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (0, 2)
+
+
+def test_survives_reopening(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    ResponseCache(path).put("m", "p", 0.8, 100, "kept")
+    reopened = ResponseCache(path)
+    assert reopened.get("m", "p", 0.8, 100) == "kept"
+    assert reopened.stats()["bytes"] == 4
+
+
+def test_lookup_accepts_a_larger_budget(tmp_path):
+    # max_tokens=400 で途切れて 800 で取り直した応答を、次回は 400 のまま引ける
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"))
+    cache.put("m", "p", 0.8, 800, "full reply")
+    assert cache.get("m", "p", 0.8, 400) == "full reply"
+    assert cache.get("m", "p", 0.8, 800) == "full reply"
+    assert cache.get("m", "p", 0.8, 1600) is None
+
+
+def test_lookup_prefers_the_smallest_sufficient_budget(tmp_path):
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"))
+    cache.put("m", "p", 0.8, 1600, "large")
+    cache.put("m", "p", 0.8, 800, "medium")
+    assert cache.get("m", "p", 0.8, 400) == "medium"
+    assert cache.get("m", "p", 0.8, 1000) == "large"
+
+
+def test_lookup_refreshes_the_entry_it_returns(tmp_path):
+    ticks = iter(range(100))
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), max_bytes=20, clock=lambda: next(ticks))
+    cache.put("m", "a", 0.8, 800, "x" * 8)
+    cache.put("m", "b", 0.8, 100, "y" * 8)
+    assert cache.get("m", "a", 0.8, 400) == "x" * 8
+    cache.put("m", "c", 0.8, 100, "z" * 8)
+    assert cache.get("m", "a", 0.8, 400) == "x" * 8
+    assert cache.get("m", "b", 0.8, 100) is None
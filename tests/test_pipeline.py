@@ -0,0 +1,184 @@
+# チャンク処理のパイプライン（並列送信・リトライ・フィルタ）
+import json
+import threading
+
+import pytest
+
+from captions import parse_combined_captions, parse_packed_captions
+from pipeline import ChunkParseError, ChunkResult, RetryPolicy, process_chunk, run_pipeline, unpack_captions
+from transcript import chunk_by_timestamp, pack_chunks, parse_transcript
+
+TEXT = "".join(f"00:00:{s:02d}\nchunk{s // 20 + 1}\n" for s in range(0, 100, 20))
+SPANS = chunk_by_timestamp(parse_transcript(TEXT), 20)
+
+
+def build_prompt(body: str) -> str:
+    return body.split("\n")[1]
+
+
+def reply(prompt: str) -> str:
+    return json.dumps([{"start": "00:00:00", "caption": prompt}])
+
+
+# ── 並列送信 ──
+def test_results_arrive_in_completion_order_with_original_indices():
+    # チャンク1だけ遅らせると、後続が先に返ってくる（並べ直しは呼び出し側）
+    release = threading.Event()
+
+    def send(prompt, on_item):
+        if prompt == "chunk1":
+            assert release.wait(5)
+        return reply(prompt)
+
+    order = []
+    for result in run_pipeline(TEXT, SPANS, build_prompt, send, json.loads, concurrency=3):
+        order.append(result.index)
+        assert result.captions == [{"start": "00:00:00", "caption": f"chunk{result.index}"}]
+        release.set()
+    assert order[0] != 1
+    assert sorted(order) == [1, 2, 3, 4, 5]
+
+
+def test_concurrency_bounds_requests_in_flight():
+    lock = threading.Lock()
+    in_flight = peak = 0
+
+    def send(prompt, on_item):
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+        threading.Event().wait(0.02)
+        with lock:
+            in_flight -= 1
+        return reply(prompt)
+
+    results = list(run_pipeline(TEXT, SPANS, build_prompt, send, json.loads, concurrency=2))
+    assert len(results) == 5
+    assert peak == 2
+
+
+def test_indices_are_kept_for_reruns():
+    results = run_pipeline(TEXT, [SPANS[1], SPANS[3]], build_prompt, lambda p, on_item: reply(p), json.loads,
+                           indices=[2, 4])
+    assert sorted((r.index, r.captions[0]["caption"]) for r in results) == [(2, "chunk2"), (4, "chunk4")]
+
+
+# ── リトライと失敗の扱い ──
+class Flaky:
+    # 最初の failures 回は error を投げる（error が無ければ壊れた応答 raw を返す）
+    def __init__(self, failures: int, error=None, raw: str = "[{"):
+        self.failures = failures
+        self.error = error
+        self.raw = raw
+        self.calls = 0
+
+    def __call__(self, prompt, on_item):
+        self.calls += 1
+        if self.calls <= self.failures:
+            if self.error is not None:
+                raise self.error
+            return self.raw
+        return reply(prompt)
+
+
+def test_retries_send_and_parse_failures_with_backoff():
+    sleeps = []
+    send = Flaky(2)
+    job = ChunkResult(1, SPANS[0], "chunk1")
+    caps = process_chunk(job, send, json.loads, RetryPolicy(attempts=3, base_delay=1.0), sleeps.append)
+    assert caps == [{"start": "00:00:00", "caption": "chunk1"}]
+    assert (send.calls, job.attempts) == (3, 3)
+    assert len(sleeps) == 2 and 0 <= sleeps[0] <= 1.0 and 0 <= sleeps[1] <= 2.0
+
+
+def test_gives_up_after_the_last_attempt_and_keeps_the_raw_reply():
+    send = Flaky(5)
+    job = ChunkResult(1, SPANS[0], "chunk1")
+    with pytest.raises(ChunkParseError) as info:
+        process_chunk(job, send, json.loads, RetryPolicy(attempts=3), lambda s: None)
+    assert info.value.raw == "[{"
+    assert (send.calls, job.attempts) == (3, 3)
+
+
+def test_non_retryable_errors_are_tried_once():
+    send = Flaky(5, error=PermissionError("400"))
+    job = ChunkResult(1, SPANS[0], "chunk1")
+    policy = RetryPolicy(attempts=4, retryable=lambda e: not isinstance(e, PermissionError))
+    with pytest.raises(PermissionError):
+        process_chunk(job, send, json.loads, policy, lambda s: None)
+    assert (send.calls, job.attempts) == (1, 1)
+
+
+def test_failed_chunks_do_not_stop_the_run():
+    def send(prompt, on_item):
+        if prompt == "chunk3":
+            raise ConnectionError("down")
+        return reply(prompt)
+
+    results = {r.index: r for r in run_pipeline(TEXT, SPANS, build_prompt, send, json.loads, concurrency=2)}
+    assert sorted(results) == [1, 2, 3, 4, 5]
+    assert isinstance(results[3].error, ConnectionError) and results[3].captions is None
+    assert all(results[i].error is None for i in (1, 2, 4, 5))
+
+
+def test_filter_errors_fail_only_that_chunk():
+    def keep(caps):
+        if caps[0]["caption"] == "chunk2":
+            raise KeyError("category")
+        return caps
+
+    results = run_pipeline(TEXT, SPANS, build_prompt, lambda p, on_item: reply(p), json.loads, keep)
+    results = {r.index: r for r in results}
+    assert isinstance(results[2].error, ChunkParseError) and results[2].error.raw == reply("chunk2")
+    assert results[2].captions is None
+    assert all(results[i].captions for i in (1, 3, 4, 5))
+
+
+# ── まとめ送信 ──
+def packed_reply(*chunk_ids) -> str:
+    chunks = [{"chunk_id": i, "captions": [{"start": "00:00:00", "end": "00:00:00", "caption": f"chunk{i}",
+                                           "category": "neutral"}]} for i in chunk_ids]
+    return json.dumps({"chunks": chunks})
+
+
+def test_unpack_orders_captions_by_chunk():
+    pack = pack_chunks(SPANS, 3)[1]
+    caps = unpack_captions(pack, parse_packed_captions(packed_reply(5, 3, 4)))
+    assert [cap["caption"] for cap in caps] == ["chunk3", "chunk4", "chunk5"]
+
+
+def test_unpack_fails_when_a_chunk_is_missing():
+    pack = pack_chunks(SPANS, 3)[1]
+    with pytest.raises(ValueError):
+        unpack_captions(pack, parse_packed_captions(packed_reply(3, 5)))
+
+
+def test_packed_replies_flow_through_the_pipeline_and_retry():
+    # 束はチャンク 1〜2 と 3〜5。チャンク番号が欠けた応答はパース失敗として送り直す
+    packs = pack_chunks(SPANS, 3)
+    replies = {1: [packed_reply(1), packed_reply(1, 2)]}
+
+    def send(prompt, on_item):
+        first = int(prompt)
+        return replies[first].pop(0) if first in replies else packed_reply(3, 4, 5)
+
+    def build_prompt(parts):
+        return str(parts[0][0])
+
+    results = run_pipeline(TEXT, packs, build_prompt, send, parse_packed_captions, retry=RetryPolicy(2, base_delay=0))
+    results = {r.index: r for r in results}
+    assert results[1].attempts == 2
+    assert [cap["caption"] for cap in results[1].captions] == ["chunk1", "chunk2"]
+    assert [cap["caption"] for cap in results[2].captions] == ["chunk3", "chunk4", "chunk5"]
+
+
+# ── テロップと見出しのまとめ生成 ──
+def test_combined_reply_splits_side_caption_onto_the_result():
+    def send(prompt, on_item):
+        caps = json.loads(packed_reply(1))["chunks"][0]["captions"]
+        return json.dumps({"captions": caps, "side_caption": {"caption": f"見出し{prompt}"}})
+
+    results = {r.index: r for r in run_pipeline(TEXT, SPANS[:2], build_prompt, send, parse_combined_captions)}
+    assert [cap["caption"] for cap in results[1].captions] == ["chunk1"]
+    assert results[2].side == [{"caption": "見出しchunk2"}]
@@ -0,0 +1,41 @@
+# クライアント側の RPM / TPM 制限
+import pytest
+
+from ratelimit import RateLimiter
+
+
+def test_waits_for_token_refill(clock):
+    limiter = RateLimiter(rpm=600, tpm=6000, clock=clock, sleep=clock.sleep)
+    assert limiter.acquire(6000) == 0
+    assert limiter.wait_time(600) == pytest.approx(6.0)
+    assert limiter.acquire(600) == pytest.approx(6.0)
+    assert clock.now == pytest.approx(6.0)
+
+
+def test_request_count_limits_independently_of_tokens(clock):
+    limiter = RateLimiter(rpm=2, tpm=100000, clock=clock, sleep=clock.sleep)
+    limiter.acquire(1)
+    limiter.acquire(1)
+    assert limiter.wait_time(1) == pytest.approx(30.0)
+
+
+def test_oversized_request_waits_for_a_full_bucket(clock):
+    # 1分の上限を超える要求でも、満タンになれば通す（永遠に待たない）
+    limiter = RateLimiter(rpm=100, tpm=1000, clock=clock, sleep=clock.sleep)
+    limiter.acquire(500)
+    assert limiter.wait_time(5000) == pytest.approx(30.0)
+
+
+def test_follows_server_headers(clock):
+    limiter = RateLimiter(rpm=100, tpm=1000, clock=clock, sleep=clock.sleep)
+    limiter.update_from_headers({"x-ratelimit-limit-tokens": "2000", "x-ratelimit-remaining-tokens": "100"})
+    snapshot = limiter.snapshot()
+    assert (snapshot["tpm_limit"], snapshot["tpm_remaining"]) == (2000, 100)
+
+
+def test_headers_never_raise_the_local_level(clock):
+    # 送信中の予約分は手元にしか無いので、サーバの残量が多くても手元の残量は増やさない
+    limiter = RateLimiter(rpm=100, tpm=1000, clock=clock, sleep=clock.sleep)
+    limiter.acquire(900)
+    limiter.update_from_headers({"x-ratelimit-remaining-tokens": "1000", "x-ratelimit-remaining-requests": "oops"})
+    assert limiter.snapshot()["tpm_remaining"] == 100
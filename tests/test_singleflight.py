@@ -0,0 +1,88 @@
+# 同一リクエストの相乗り
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight
+
+TIMEOUT = 5.0
+
+
+def wait_until(condition) -> None:
+    # 相乗り側は Future で待つだけで合図を出さないので、期限付きで数が揃うのを待つ
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline, "相乗りが揃いませんでした"
+        time.sleep(0.001)
+
+
+def start_callers(flight: SingleFlight, fn, followers: int) -> tuple[list, list]:
+    # 同じキーで呼ぶスレッドを作り、先頭だけ起動する（残りは先頭が fn に入ってから呼び出し側で起動する）
+    results = []
+
+    def call():
+        try:
+            results.append(flight.do("k", fn))
+        except Exception as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(followers + 1)]
+    threads[0].start()
+    return threads, results
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight()
+    entered, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        entered.set()
+        assert release.wait(TIMEOUT)
+        return "done"
+
+    threads, results = start_callers(flight, slow, 3)
+    assert entered.wait(TIMEOUT)
+    for t in threads[1:]:
+        t.start()
+    wait_until(lambda: flight.stats()["coalesced"] == 3)
+    release.set()
+    for t in threads:
+        t.join(TIMEOUT)
+        assert not t.is_alive()
+    assert results == ["done"] * 4
+    assert len(calls) == 1
+    assert flight.stats() == {"calls": 1, "coalesced": 3, "in_flight": 0}
+
+
+def test_errors_are_shared_and_the_key_is_released():
+    flight = SingleFlight()
+    entered, release = threading.Event(), threading.Event()
+
+    def failing():
+        entered.set()
+        assert release.wait(TIMEOUT)
+        raise RuntimeError("boom")
+
+    threads, results = start_callers(flight, failing, 1)
+    assert entered.wait(TIMEOUT)
+    threads[1].start()
+    wait_until(lambda: flight.stats()["coalesced"] == 1)
+    release.set()
+    for t in threads:
+        t.join(TIMEOUT)
+        assert not t.is_alive()
+    assert [type(r) for r in results] == [RuntimeError, RuntimeError]
+    # 終わったキーは次の呼び出しで改めて実行する
+    assert flight.do("k", lambda: "again") == "again"
+    assert flight.stats()["calls"] == 2
+
+
+def test_sequential_calls_are_not_coalesced():
+    flight = SingleFlight()
+    assert [flight.do("k", lambda: 1), flight.do("k", lambda: 2), flight.do("j", lambda: 3)] == [1, 2, 3]
+    assert flight.stats()["coalesced"] == 0
+    with pytest.raises(ValueError):
+        flight.do("k", lambda: int("x"))
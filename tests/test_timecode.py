@@ -0,0 +1,28 @@
+# タイムコードの整数演算と文字列の解釈
+import pytest
+
+from timecode import format_frames, format_hms, parse_ms
+
+
+@pytest.mark.parametrize("timecode, fps, expected", [
+    ("01:23:45", 30, 5025000),
+    ("01:23:45:15", 30, 5025500),
+    ("00:00:01;12", 24, 1500),
+    ("00:00:01,250", 30, 1250),
+    ("00:01.500", 30, 1500),
+    ("12:34", 30, 754000),
+    (" 00:00:05 ", 30, 5000),
+])
+def test_parse_ms(timecode, fps, expected):
+    assert parse_ms(timecode, fps) == expected
+
+
+@pytest.mark.parametrize("timecode", ["", "abc", "00:0", "1:2:3"])
+def test_parse_ms_rejects_garbage(timecode):
+    assert parse_ms(timecode) is None
+
+
+def test_format_round_trip():
+    assert format_hms(5025999) == "01:23:45"
+    assert format_frames(5025500, 30) == "01:23:45:15"
+    assert parse_ms(format_frames(5025500, 30), 30) == 5025500
@@ -0,0 +1,57 @@
+# tiktoken エンコーディングの読み込みと概算へのフォールバック
+import sys
+
+import pytest
+
+import tokenizer
+from tokenizer import EncodingMissing, approx_tokens
+
+
+@pytest.fixture
+def empty_cache(tmp_path, monkeypatch):
+    # seed されていないノードと同じ状態（空のキャッシュ）
+    monkeypatch.setattr(tokenizer, "TIKTOKEN_CACHE_DIR", tmp_path)
+    tokenizer.encoding_for.cache_clear()
+    tokenizer.token_counter.cache_clear()
+    yield tmp_path
+    tokenizer.encoding_for.cache_clear()
+    tokenizer.token_counter.cache_clear()
+
+
+def test_approx_counts_japanese_per_char_and_ascii_per_four():
+    assert approx_tokens("") == 0
+    assert approx_tokens("糖質") == 2
+    assert approx_tokens("abcde") == 2
+    assert approx_tokens("糖質 abc") == 3
+
+
+def test_missing_encoding_raises_without_downloading(empty_cache, monkeypatch):
+    import tiktoken
+
+    def download(name):
+        raise AssertionError("ダウンロードしてはいけない")
+
+    monkeypatch.setattr(tiktoken, "get_encoding", download)
+    with pytest.raises(EncodingMissing, match="tokenizer.py seed"):
+        tokenizer.encoding_for("gpt-3.5-turbo")
+
+
+def test_counter_falls_back_to_the_approximation(empty_cache):
+    count = tokenizer.token_counter("gpt-3.5-turbo")
+    assert count("糖質を抑える") == approx_tokens("糖質を抑える")
+    assert tokenizer.is_approximate("gpt-3.5-turbo")
+
+
+def test_seed_file_is_found_by_the_cache_lookup(empty_cache, tmp_path_factory):
+    source = tmp_path_factory.mktemp("src") / "cl100k_base.tiktoken"
+    source.write_text("")
+    assert tokenizer.seed_file(source) == tokenizer.cache_path("cl100k_base")
+    assert tokenizer.is_cached("gpt-3.5-turbo")
+
+
+def test_status_exits_1_when_an_encoding_is_missing(empty_cache, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", ["tokenizer.py", "status", "--model", "gpt-3.5-turbo"])
+    with pytest.raises(SystemExit) as info:
+        tokenizer.main()
+    assert info.value.code == 1
+    assert "キャッシュなし" in capsys.readouterr().out
@@ -0,0 +1,157 @@
+# 原稿の取り込み・チャンク分割・章分割
+#   実行: python -m pytest -q
+from array import array
+
+import pytest
+
+from transcript import (
+    FMT_FRAMES, FMT_HMS, FMT_MMSS, FMT_SRT, FMT_VTT, ChunkSpan, auto_pack_size, chunk_by_timestamp, detect_format,
+    pack_chunks, pack_texts, parse_transcript, partition_chapters, segment_durations, span_text,
+)
+
+
+def segments(table):
+    return [(table.start_ms[i], table.end_ms[i], table.segment_text(i)) for i in range(len(table))]
+
+
+# ── フォーマット判定と取り込み ──
+def test_hms_lines_end_at_next_start():
+    text = "00:00:01\nこんにちは\n00:00:05\n今日は\n"
+    table = parse_transcript(text)
+    assert table.fmt == FMT_HMS
+    assert segments(table) == [
+        (1000, 5000, "00:00:01\nこんにちは\n"),
+        (5000, 5000, "00:00:05\n今日は\n"),
+    ]
+
+
+def test_frames_use_fps():
+    text = "00:00:01:15 はい\n00:00:02:00 どうも\n"
+    assert detect_format(text) == FMT_FRAMES
+    table = parse_transcript(text, fps=30)
+    assert list(table.start_ms) == [1500, 2000]
+    assert list(parse_transcript(text, fps=24).start_ms) == [1625, 2000]
+
+
+def test_mmss_lines():
+    text = "00:05 はじめに\n01:30 本題\n"
+    table = parse_transcript(text)
+    assert table.fmt == FMT_MMSS
+    assert list(table.start_ms) == [5000, 90000]
+
+
+def test_srt_cue_numbers_belong_to_their_own_block():
+    text = (
+        "1\n00:00:01,000 --> 00:00:03,500\n最初の字幕\n\n"
+        "2\n00:00:04,000 --> 00:00:06,250\n次の字幕\n"
+    )
+    table = parse_transcript(text)
+    assert table.fmt == FMT_SRT
+    assert segments(table) == [
+        (1000, 3500, "1\n00:00:01,000 --> 00:00:03,500\n最初の字幕\n\n"),
+        (4000, 6250, "2\n00:00:04,000 --> 00:00:06,250\n次の字幕\n"),
+    ]
+
+
+def test_vtt_cue_ids_and_short_timestamps():
+    text = (
+        "WEBVTT\n\n"
+        "intro\n00:01.000 --> 00:02.500\nようこそ\n\n"
+        "01:00:00.000 --> 01:00:01.000\n長尺の途中\n"
+    )
+    table = parse_transcript(text)
+    assert table.fmt == FMT_VTT
+    assert segments(table) == [
+        (1000, 2500, "WEBVTT\n\nintro\n00:01.000 --> 00:02.500\nようこそ\n\n"),
+        (3600000, 3601000, "01:00:00.000 --> 01:00:01.000\n長尺の途中\n"),
+    ]
+
+
+def test_srt_detected_without_header():
+    assert detect_format("1\n00:00:01,000 --> 00:00:02,000\nx\n") == FMT_SRT
+    assert detect_format("00:00:01.000 --> 00:00:02.000\nx\n") == FMT_VTT
+
+
+def test_text_without_timecodes_is_one_segment():
+    table = parse_transcript("タイムコードのない原稿\n")
+    assert segments(table) == [(0, 0, "タイムコードのない原稿\n")]
+
+
+# ── チャンク分割 ──
+def test_chunks_cover_text_without_gaps():
+    text = "".join(f"00:00:{s:02d}\n発言{s}\n" for s in range(0, 60, 3))
+    table = parse_transcript(text)
+    spans = chunk_by_timestamp(table, 20)
+    assert "".join(span_text(text, span) for span in spans) == text
+    assert [(span.start_ms, span.end_ms) for span in spans] == [(0, 21000), (21000, 42000), (42000, 57000)]
+
+
+def test_chunk_boundary_is_inclusive_of_max_seconds():
+    # 先頭から max_seconds ちょうどのセグメントで次のチャンクに切り替わる
+    text = "00:00:00\na\n00:00:19\nb\n00:00:20\nc\n"
+    spans = chunk_by_timestamp(parse_transcript(text), 20)
+    assert [span_text(text, span) for span in spans] == ["00:00:00\na\n00:00:19\nb\n", "00:00:20\nc\n"]
+
+
+def test_no_chunks_for_empty_text():
+    assert chunk_by_timestamp(parse_transcript("")) == []
+
+
+# ── 章分割 ──
+@pytest.mark.parametrize("n_chapters", [1, 2, 3, 5, 8])
+def test_partition_always_returns_n_chapters(n_chapters):
+    # 重みが先頭に偏っていても、セグメントが足りる限り N 章ちょうどにする
+    text = "".join(f"00:{m:02d}:00\n話{m}\n" for m in range(8))
+    table = parse_transcript(text)
+    weights = array("q", [1000, 1, 1, 1, 1, 1, 1, 1])
+    spans = partition_chapters(table, n_chapters, weights)
+    assert len(spans) == n_chapters
+    assert "".join(span_text(text, span) for span in spans) == text
+    assert all(span.start < span.end for span in spans)
+
+
+def test_partition_caps_at_segment_count():
+    table = parse_transcript("00:00:00\na\n00:01:00\nb\n")
+    assert len(partition_chapters(table, 5, segment_durations(table))) == 2
+    assert partition_chapters(parse_transcript(""), 3, array("q")) == []
+
+
+def test_partition_balances_durations():
+    text = "".join(f"00:{m:02d}:00\n話{m}\n" for m in range(12))
+    table = parse_transcript(text)
+    spans = partition_chapters(table, 3, segment_durations(table))
+    # 1分のセグメント11個（最後は長さ0）を3章に分けるので、章の長さの差は1セグメント分までに収まる
+    lengths = [span.end_ms - span.start_ms for span in spans]
+    assert max(lengths) - min(lengths) <= 60000
+
+
+def test_partition_with_zero_weights_splits_by_count():
+    table = parse_transcript("".join(f"00:00:{s:02d}\nx\n" for s in range(6)))
+    spans = partition_chapters(table, 3, array("q", [0] * 6))
+    assert [span.start_ms for span in spans] == [0, 2000, 4000]
+
+
+# ── 連続チャンクの束 ──
+SPANS = [ChunkSpan(i * 10, i * 10 + 10, i * 20000, i * 20000 + 19000) for i in range(7)]
+
+
+@pytest.mark.parametrize("size, expected", [(1, [1] * 7), (3, [2, 2, 3]), (4, [3, 4]), (7, [7]), (10, [7])])
+def test_pack_chunks_balances_pack_sizes(size, expected):
+    packs = pack_chunks(SPANS, size)
+    assert [len(pack.parts) for pack in packs] == expected
+    assert [span for pack in packs for span in pack.parts] == SPANS
+    assert [pack.first for pack in packs] == [1 + sum(expected[:k]) for k in range(len(expected))]
+
+
+def test_pack_covers_its_parts():
+    pack = pack_chunks(SPANS, 3)[1]
+    assert (pack.start, pack.end, pack.start_ms, pack.end_ms) == (20, 40, 40000, 79000)
+    text = "".join(f"{i:<9}\n" for i in range(7))
+    assert pack_texts(text, pack) == [(3, "2        \n"), (4, "3        \n")]
+
+
+def test_auto_pack_size_respects_output_and_context_limits():
+    # 出力上限 1000 ÷ 1チャンクの出力 200 = 5、コンテキスト (4000 - 1000) ÷ (300 + 200) = 6、上限 8
+    assert auto_pack_size([100, 300, 200], 1000, 200, 4000, 1000, 8) == 5
+    assert auto_pack_size([100, 300, 200], 1000, 200, 4000, 1000, 3) == 3
+    assert auto_pack_size([5000], 1000, 200, 4000, 1000, 8) == 1
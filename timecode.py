@@ -0,0 +1,53 @@
+import re
+from typing import Optional
+
+# ── 定数 ──
+FPS = 30
+
+# ── タイムコードのパターン（モジュール読み込み時に1回だけコンパイル） ──
+HMS_RE = re.compile(r'(\d{2}):(\d{2}):(\d{2})(?![:;]\d)')
+FRAMES_RE = re.compile(r'(\d{2}):(\d{2}):(\d{2})[:;](\d{2})')
+MMSS_RE = re.compile(r'(\d{1,3}):(\d{2})(?![:\d])')
+CUE_RE = re.compile(
+    r'[ \t]*(?:(\d+):)?(\d{2}):(\d{2})[,.](\d{3})[ \t]*-->[ \t]*(?:(\d+):)?(\d{2}):(\d{2})[,.](\d{3})'
+)
+# 単体のタイムコード文字列（HH:MM:SS / HH:MM:SS:FF / HH:MM:SS.mmm / mm:ss）
+TIMECODE_RE = re.compile(r'\s*(?:(\d{1,2}):)?(\d{1,3}):(\d{2})(?:[:;](\d{2})|[,.](\d{3}))?\s*')
+
+
+# ── 整数演算（ミリ秒・フレーム） ──
+def hms_to_ms(h: int, m: int, s: int) -> int:
+    return (h * 3600 + m * 60 + s) * 1000
+
+
+def frames_to_ms(frames: int, fps: int = FPS) -> int:
+    return frames * 1000 // fps
+
+
+def parse_ms(timecode: str, fps: int = FPS) -> Optional[int]:
+    # 解釈できない場合は None を返す
+    m = TIMECODE_RE.fullmatch(timecode)
+    if not m:
+        return None
+    h, mi, s, ff, frac = m.groups()
+    ms = hms_to_ms(int(h) if h else 0, int(mi), int(s))
+    if ff:
+        ms += frames_to_ms(int(ff), fps)
+    elif frac:
+        ms += int(frac)
+    return ms
+
+
+# ── 書き出し ──
+def format_hms(ms: int) -> str:
+    s = ms // 1000
+    h, s = divmod(s, 3600)
+    m, s = divmod(s, 60)
+    return f"{h:02d}:{m:02d}:{s:02d}"
+
+
+def format_frames(ms: int, fps: int = FPS) -> str:
+    s, rem = divmod(ms, 1000)
+    h, s = divmod(s, 3600)
+    m, s = divmod(s, 60)
+    return f"{h:02d}:{m:02d}:{s:02d}:{rem * fps // 1000:02d}"
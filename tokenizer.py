@@ -0,0 +1,126 @@
+# tiktoken のエンコーディングをネットワークなしで読み込む
+#   デプロイ手順（ネットワークのある環境で1回。エンコーディングはリポジトリに含めていない）:
+#     python tokenizer.py seed --model gpt-3.5-turbo gpt-4o-mini   # cl100k_base / o200k_base を取得
+#     python tokenizer.py seed --file cl100k_base.tiktoken          # 手元の .tiktoken ファイルを取り込む
+#     python tokenizer.py status --model gpt-3.5-turbo              # 揃っていなければ終了コード 1
+#   tiktoken_cache/ ごとデプロイすれば、レンダーノードでは BPE ファイルをダウンロードしない。
+#   キャッシュが無いノードでもダウンロードはせず、トークン数を概算で数える
+import argparse
+import functools
+import hashlib
+import os
+import shutil
+import sys
+from pathlib import Path
+from typing import Callable
+
+# tiktoken はキャッシュ先を TIKTOKEN_CACHE_DIR から読む（未指定ならアプリと同じ場所の tiktoken_cache/）
+TIKTOKEN_CACHE_DIR = Path(os.environ.setdefault(
+    "TIKTOKEN_CACHE_DIR", str(Path(__file__).resolve().with_name("tiktoken_cache")),
+))
+ENCODING_URL = "https://openaipublic.blob.core.windows.net/encodings/{name}.tiktoken"
+# 別名のエンコーディングが同じ BPE ファイルを使う場合
+ENCODING_FILES = {"o200k_harmony": "o200k_base"}
+
+
+def encoding_name(model: str) -> str:
+    import tiktoken
+
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        # 未知のモデル名（互換サーバのモデルなど）は現行モデルと同じ語彙で数える
+        return "o200k_base"
+
+
+def cache_path(name: str) -> Path:
+    # tiktoken と同じく、ダウンロード元 URL の SHA-1 をファイル名にする
+    url = ENCODING_URL.format(name=ENCODING_FILES.get(name, name))
+    return TIKTOKEN_CACHE_DIR / hashlib.sha1(url.encode()).hexdigest()
+
+
+def is_cached(model: str) -> bool:
+    return cache_path(encoding_name(model)).exists()
+
+
+class EncodingMissing(RuntimeError):
+    # エンコーディングがキャッシュに無い（seed されていない）
+    pass
+
+
+# ── 読み込み（初めてトークンを数えるときに1回だけ） ──
+@functools.lru_cache(maxsize=None)
+def encoding_for(model: str):
+    # キャッシュに無ければ tiktoken にダウンロードさせず、すぐ EncodingMissing を投げる
+    import tiktoken
+
+    name = encoding_name(model)
+    if not cache_path(name).exists():
+        raise EncodingMissing(
+            f"{name} のエンコーディングが {TIKTOKEN_CACHE_DIR} にありません。"
+            f"`python tokenizer.py seed --model {model}` で事前に用意してください。"
+        )
+    return tiktoken.get_encoding(name)
+
+
+def approx_tokens(text: str) -> int:
+    # エンコーディングが無いときの概算。日本語は1文字≒1トークン、ASCII は4文字≒1トークンとし、やや多めに数える
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return len(text) - ascii_chars + -(-ascii_chars // 4)
+
+
+@functools.lru_cache(maxsize=None)
+def token_counter(model: str) -> Callable[[str], int]:
+    # エンコーディングがあれば正確に、無ければ approx_tokens で数える（後から seed してもプロセスの再起動までは概算のまま）
+    try:
+        encode = encoding_for(model).encode
+    except EncodingMissing:
+        return approx_tokens
+    return lambda text: len(encode(text))
+
+
+def is_approximate(model: str) -> bool:
+    return token_counter(model) is approx_tokens
+
+
+# ── 事前準備 ──
+def seed_model(model: str) -> Path:
+    # 通常どおり読み込むと tiktoken が TIKTOKEN_CACHE_DIR に保存する（ここだけはダウンロードする）
+    import tiktoken
+
+    name = encoding_name(model)
+    tiktoken.get_encoding(name)
+    return cache_path(name)
+
+
+def seed_file(source: Path) -> Path:
+    # ファイル名（拡張子なし）をエンコーディング名として取り込む。
+    # 中身の検証は読み込み時に tiktoken が expected_hash で行う
+    dest = cache_path(source.stem)
+    TIKTOKEN_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(source, dest)
+    return dest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="tiktoken のエンコーディングを TIKTOKEN_CACHE_DIR（既定は tiktoken_cache/）に用意する")
+    parser.add_argument("command", choices=["seed", "status"])
+    parser.add_argument("--model", nargs="*", default=[os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")])
+    parser.add_argument("--file", nargs="*", default=[], help="取り込む .tiktoken ファイル")
+    args = parser.parse_args()
+
+    if args.command == "seed":
+        for source in args.file:
+            print(f"{source} → {seed_file(Path(source))}")
+        for model in args.model if not args.file else []:
+            print(f"{model}（{encoding_name(model)}）→ {seed_model(model)}")
+    missing = [model for model in args.model if not is_cached(model)]
+    for model in args.model:
+        state = "なし" if model in missing else "あり"
+        print(f"{model}: {encoding_name(model)} / キャッシュ{state}（{TIKTOKEN_CACHE_DIR}）")
+    if missing:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+import hashlib
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from typing import Callable, Iterator, NamedTuple, Sequence
+
+from timecode import CUE_RE, FPS, FRAMES_RE, HMS_RE, MMSS_RE, frames_to_ms, hms_to_ms
+
+# ── 定数 ──
+CHUNK_SECONDS = 20
+DETECT_LINES = 50
+
+
+# ── 対応フォーマット ──
+FMT_HMS = "hms"        # 00:00:05 本文
+FMT_FRAMES = "frames"  # 00:00:05:12 本文
+FMT_MMSS = "mmss"      # 00:05 本文
+FMT_SRT = "srt"        # 00:00:05,000 --> 00:00:08,000
+FMT_VTT = "vtt"        # WEBVTT / 00:05.000 --> 00:08.000
+
+
+# ── チャンク範囲（原稿へのオフセット＋ミリ秒） ──
+class ChunkSpan(NamedTuple):
+    start: int     # 原稿内の開始オフセット
+    end: int       # 原稿内の終了オフセット（排他的）
+    start_ms: int  # 最初のセグメントの開始時刻
+    end_ms: int    # 最後のセグメントの終了時刻
+
+
+def span_text(text: str, span: ChunkSpan) -> str:
+    # プロンプト組み立て時にだけ文字列を切り出す
+    return text[span.start:span.end]
+
+
+# ── セグメント表（列ごとの整数配列） ──
+class SegmentTable:
+    # 1セグメント＝タイムコード1つ分。行ごとの Python オブジェクトは作らず、
+    # 開始/終了時刻（ミリ秒）と原稿内オフセットを array に詰める
+    __slots__ = ("text", "fmt", "start_ms", "end_ms", "text_start", "text_end")
+
+    def __init__(self, text: str, fmt: str):
+        self.text = text
+        self.fmt = fmt
+        self.start_ms = array("q")
+        self.end_ms = array("q")
+        self.text_start = array("q")
+        self.text_end = array("q")
+
+    def __len__(self) -> int:
+        return len(self.start_ms)
+
+    def append(self, start_ms: int, end_ms: int, text_start: int, text_end: int) -> None:
+        self.start_ms.append(start_ms)
+        self.end_ms.append(end_ms)
+        self.text_start.append(text_start)
+        self.text_end.append(text_end)
+
+    def segment_text(self, i: int) -> str:
+        return self.text[self.text_start[i]:self.text_end[i]]
+
+
+# ── フォーマット判定 ──
+def detect_format(text: str) -> str:
+    pos = 0
+    n = len(text)
+    for _ in range(DETECT_LINES):
+        if pos >= n:
+            break
+        nl = text.find("\n", pos)
+        line_end = n if nl < 0 else nl
+        line = text[pos:line_end].strip()
+        if line.startswith("WEBVTT"):
+            return FMT_VTT
+        if CUE_RE.match(line):
+            return FMT_SRT if "," in line.split("-->")[0] else FMT_VTT
+        if FRAMES_RE.match(line):
+            return FMT_FRAMES
+        if HMS_RE.match(line):
+            return FMT_HMS
+        if MMSS_RE.match(line):
+            return FMT_MMSS
+        pos = line_end + 1
+    return FMT_HMS
+
+
+# ── 取り込み（1パス） ──
+def parse_transcript(text: str, fps: int = FPS) -> SegmentTable:
+    fmt = detect_format(text)
+    table = SegmentTable(text, fmt)
+    cue = fmt in (FMT_SRT, FMT_VTT)
+    match_at = {
+        FMT_HMS: HMS_RE.match,
+        FMT_FRAMES: FRAMES_RE.match,
+        FMT_MMSS: MMSS_RE.match,
+        FMT_SRT: CUE_RE.match,
+        FMT_VTT: CUE_RE.match,
+    }[fmt]
+    find = text.find
+    n = len(text)
+    pos = 0
+    prev_start = 0
+    prev_blank = True
+    # 終了オフセットがまだ決まっていない直前のセグメント
+    seg_start = 0
+    seg_start_ms = None
+    seg_end_ms = None
+
+    while pos < n:
+        nl = find("\n", pos)
+        line_end = n if nl < 0 else nl + 1
+        m = match_at(text, pos)
+        if m:
+            g = m.groups()
+            if cue:
+                start_ms = hms_to_ms(int(g[0] or 0), int(g[1]), int(g[2])) + int(g[3])
+                end_ms = hms_to_ms(int(g[4] or 0), int(g[5]), int(g[6])) + int(g[7])
+                # SRT の番号行・VTT のキュー ID はそのキューのブロックに含める
+                block_start = pos if prev_blank else prev_start
+            else:
+                if fmt == FMT_MMSS:
+                    start_ms = hms_to_ms(0, int(g[0]), int(g[1]))
+                else:
+                    start_ms = hms_to_ms(int(g[0]), int(g[1]), int(g[2]))
+                    if fmt == FMT_FRAMES:
+                        start_ms += frames_to_ms(int(g[3]), fps)
+                end_ms = None
+                block_start = pos
+            if seg_start_ms is not None:
+                # 行タイムコード形式は次のセグメントの開始を終了時刻とする
+                table.append(seg_start_ms, start_ms if seg_end_ms is None else seg_end_ms, seg_start, block_start)
+                seg_start = block_start
+            seg_start_ms = start_ms
+            seg_end_ms = end_ms
+        if cue:
+            prev_blank = not text[pos:line_end].strip()
+            prev_start = pos
+        pos = line_end
+
+    if seg_start_ms is not None:
+        table.append(seg_start_ms, seg_start_ms if seg_end_ms is None else seg_end_ms, seg_start, n)
+    elif text:
+        # タイムコードが1つもない場合は全体を1セグメントとして扱う
+        table.append(0, 0, 0, n)
+    return table
+
+
+# ── タイムコード単位分割（20秒以上で分割） ──
+def iter_chunks(table: SegmentTable, max_seconds: int = CHUNK_SECONDS) -> Iterator[ChunkSpan]:
+    limit = max_seconds * 1000
+    starts, ends = table.start_ms, table.end_ms
+    offsets = table.text_start
+    first = 0
+
+    for i in range(1, len(table)):
+        if starts[i] - starts[first] >= limit:
+            yield ChunkSpan(offsets[first], offsets[i], starts[first], ends[i - 1])
+            first = i
+
+    if len(table):
+        yield ChunkSpan(offsets[first], table.text_end[-1], starts[first], ends[-1])
+
+
+def chunk_by_timestamp(table: SegmentTable, max_seconds: int = CHUNK_SECONDS) -> list[ChunkSpan]:
+    return list(iter_chunks(table, max_seconds))
+
+
+# ── トークン上限でまとめる分割 ──
+def iter_token_chunks(
+    table: SegmentTable,
+    token_counts: Sequence[int],
+    max_tokens: int,
+    max_seconds: int,
+) -> Iterator[ChunkSpan]:
+    # トークン数が max_tokens を超えるか、尺が max_seconds に達したら次のチャンクへ
+    # 1セグメントだけで上限を超える場合はそのセグメント単独で1チャンクにする
+    limit = max_seconds * 1000
+    starts, ends = table.start_ms, table.end_ms
+    offsets = table.text_start
+    first = 0
+    used = 0
+
+    for i in range(len(table)):
+        tokens = token_counts[i]
+        if i > first and (used + tokens > max_tokens or starts[i] - starts[first] >= limit):
+            yield ChunkSpan(offsets[first], offsets[i], starts[first], ends[i - 1])
+            first = i
+            used = 0
+        used += tokens
+
+    if len(table):
+        yield ChunkSpan(offsets[first], table.text_end[-1], starts[first], ends[-1])
+
+
+def pack_by_tokens(
+    table: SegmentTable,
+    token_counts: Sequence[int],
+    max_tokens: int,
+    max_seconds: int,
+) -> list[ChunkSpan]:
+    return list(iter_token_chunks(table, token_counts, max_tokens, max_seconds))
+
+
+# ── 連続チャンクの束（指示文を1回だけ送るために K チャンクを1リクエストにまとめる） ──
+class ChunkPack(NamedTuple):
+    # start/end/start_ms/end_ms は束全体の範囲なので、ChunkSpan と同じように扱える
+    start: int
+    end: int
+    start_ms: int
+    end_ms: int
+    first: int  # 先頭チャンクの通し番号（1始まり）
+    parts: tuple
+
+
+def auto_pack_size(
+    chunk_tokens: Sequence[int],
+    fixed_tokens: int,
+    output_tokens_per_chunk: int,
+    context_tokens: int,
+    max_output_tokens: int,
+    max_chunks: int,
+) -> int:
+    # 出力見込みが出力上限に、指示文＋最長チャンク×K＋出力見込みがコンテキストに収まる最大の K
+    largest = max(chunk_tokens, default=0)
+    by_output = max_output_tokens // output_tokens_per_chunk
+    by_context = (context_tokens - fixed_tokens) // (largest + output_tokens_per_chunk)
+    return max(1, min(max_chunks, by_output, by_context))
+
+
+def pack_chunks(spans: Sequence[ChunkSpan], size: int) -> list[ChunkPack]:
+    # 束の数を先に決めてから均等に割り振る（最後の束だけ小さくならないように）
+    n_packs = -(-len(spans) // size)
+    packs = []
+    first = 0
+    for p in range(n_packs):
+        last = (p + 1) * len(spans) // n_packs
+        parts = tuple(spans[first:last])
+        packs.append(ChunkPack(parts[0].start, parts[-1].end, parts[0].start_ms, parts[-1].end_ms, first + 1, parts))
+        first = last
+    return packs
+
+
+def pack_texts(text: str, pack: ChunkPack) -> list[tuple[int, str]]:
+    return [(pack.first + k, span_text(text, span)) for k, span in enumerate(pack.parts)]
+
+
+# ── 章分割（尺・トークン数で均等に N 分割） ──
+def segment_durations(table: SegmentTable) -> array:
+    # 次のセグメントまでの間隔を重みにする（最後だけ自身の長さ）
+    starts = table.start_ms
+    n = len(table)
+    weights = array("q", (starts[i + 1] - starts[i] for i in range(n - 1)))
+    if n:
+        weights.append(table.end_ms[-1] - starts[-1])
+    return weights
+
+
+def segment_token_counts(table: SegmentTable, count_tokens: Callable[[str], int]) -> array:
+    return array("q", (count_tokens(table.segment_text(i)) for i in range(len(table))))
+
+
+def partition_chapters(table: SegmentTable, n_chapters: int, weights: array) -> list[ChunkSpan]:
+    # 累積重みが k/N を跨ぐ位置で切る1パスの分割。セグメント数が足りる限り必ず N 章にする
+    n = len(table)
+    k = min(n_chapters, n)
+    if k == 0:
+        return []
+    total = sum(weights)
+    if total <= 0:
+        weights = array("q", [1]) * n
+        total = n
+
+    starts, ends = table.start_ms, table.end_ms
+    offsets = table.text_start
+    spans = []
+    first = 0
+    acc = 0
+    for i in range(n):
+        w = weights[i]
+        left = k - len(spans)  # 現在の章を含む残りの章数
+        if left > 1 and i > first:
+            target = total * (len(spans) + 1) / k
+            # 残りのセグメントがちょうど残りの章数なら必ず切る
+            if n - i == left - 1 or acc + w - target > target - acc:
+                spans.append(ChunkSpan(offsets[first], offsets[i], starts[first], ends[i - 1]))
+                first = i
+        acc += w
+
+    spans.append(ChunkSpan(offsets[first], table.text_end[-1], starts[first], ends[-1]))
+    return spans
+
+
+# ── 解析済み原稿（本文ハッシュをキーに使い回す） ──
+def transcript_key(text: str, fps: int = FPS) -> str:
+    return f"{hashlib.blake2b(text.encode(), digest_size=16).hexdigest()}:{fps}"
+
+
+class ParsedTranscript:
+    # セグメント表・トークン数・チャンク分割結果をまとめて保持する。
+    # 本文（と fps）が変わらない限り、再実行やボタン間で同じものを使う。
+    # 貼り付けた時点で全体を解析する（見積もり・進捗の総数・失敗チャンクの再実行にチャンク一覧が要る）。
+    # 3時間尺でも解析は十数ミリ秒なので、iter_chunks で逐次流す経路は使わず、一覧をパイプラインに渡す
+    __slots__ = ("key", "table", "_token_counts", "_token_prefix", "_chunks")
+
+    def __init__(self, text: str, fps: int = FPS):
+        self.key = transcript_key(text, fps)
+        self.table = parse_transcript(text, fps)
+        self._token_counts = None
+        self._token_prefix = None
+        self._chunks = {}
+
+    @property
+    def text(self) -> str:
+        return self.table.text
+
+    def token_counts(self, count_tokens: Callable[[str], int]) -> array:
+        if self._token_counts is None:
+            self._token_counts = segment_token_counts(self.table, count_tokens)
+        return self._token_counts
+
+    def total_tokens(self, count_tokens: Callable[[str], int]) -> int:
+        return sum(self.token_counts(count_tokens))
+
+    def span_tokens(self, spans: Sequence[ChunkSpan], count_tokens: Callable[[str], int]) -> list[int]:
+        # チャンクはセグメント境界で切れているので、セグメントごとのトークン数の累積和から引く
+        if self._token_prefix is None:
+            self._token_prefix = list(accumulate(self.token_counts(count_tokens), initial=0))
+        prefix, firsts = self._token_prefix, self.table.text_start
+        return [prefix[bisect_left(firsts, span.end)] - prefix[bisect_left(firsts, span.start)] for span in spans]
+
+    def chunks(self, max_seconds: int = CHUNK_SECONDS) -> list[ChunkSpan]:
+        key = ("time", max_seconds)
+        if key not in self._chunks:
+            self._chunks[key] = chunk_by_timestamp(self.table, max_seconds)
+        return self._chunks[key]
+
+    def token_chunks(self, count_tokens: Callable[[str], int], max_tokens: int, max_seconds: int) -> list[ChunkSpan]:
+        key = ("tokens", max_tokens, max_seconds)
+        if key not in self._chunks:
+            self._chunks[key] = pack_by_tokens(self.table, self.token_counts(count_tokens), max_tokens, max_seconds)
+        return self._chunks[key]